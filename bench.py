@@ -0,0 +1,328 @@
+#! /usr/bin/env python3
+"""
+Benchmarks for BOLT11 encoding and decoding and for every MockDaemon
+command, the latter against each state backend with the state already
+holding 1k, 10k and 100k invoices.
+
+    ./bench.py run --output bench.json
+    ./bench.py run --sizes 1000 --backends memory sqlite --baseline bench.json
+    ./bench.py compare bench.json new-bench.json
+    ./bench.py startup --output startup.json
+
+'startup' times whole CLI invocations of each subcommand, most of which
+is interpreter startup and imports.
+
+Results are written as JSON, keyed by benchmark name ('codec/lnencode',
+'sqlite/10000/markpaid', ...). Comparing against a stored baseline lists
+everything that got slower by more than --threshold and exits non-zero if
+anything did.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+import argparse
+import platform
+import tempfile
+
+import mock_c_lightning
+from mock_c_lightning import (MockDaemon, Bolt11Template, Invoice,
+                              encode_bolt11, MOCK_BOLT11)
+from lightning_payencode import bech32
+from lightning_payencode.lnaddr import lndecode
+
+BACKENDS = ['memory', 'json', 'journal', 'sqlite']
+SIZES = [1000, 10000, 100000]
+THRESHOLD = 0.2
+
+PREIMAGE = "00" * 32
+PAYMENT_HASH = hashlib.sha256(bytes(32)).hexdigest()
+DATE = 1500000000
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "mock_c_lightning.py")
+
+# argv of each CLI invocation timed by 'startup', given the run number
+STARTUP_COMMANDS = [
+    ('invoice',          lambda n: ['invoice', '1000', "startup%d" % n,
+                                    "benchmark", '3600', "%064x" % n]),
+    ('listinvoices',     lambda n: ['listinvoices']),
+    ('markpaid',         lambda n: ['markpaid', "startup%d" % n]),
+    ('delinvoice',       lambda n: ['delinvoice', "startup%d" % n, 'paid']),
+    ('advancetime',      lambda n: ['advancetime', '1']),
+    ('autocleaninvoice', lambda n: ['autocleaninvoice']),
+    ('getstats',         lambda n: ['getstats']),
+    ('reset',            lambda n: ['reset']),
+]
+
+###############################################################################
+
+def _time(fn, ops):
+    """ Calls fn(n) for n in range(ops), timing each call. """
+    times = []
+    for n in range(ops):
+        start = time.perf_counter()
+        fn(n)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'ops':     ops,
+            'mean_us': sum(times) / ops * 1e6,
+            'min_us':  times[0] * 1e6,
+            'p50_us':  times[ops // 2] * 1e6}
+
+
+def _bench(results, name, fn, ops):
+    try:
+        results[name] = _time(fn, ops)
+    except Exception as e:
+        # eg. a secp256k1 build without what lndecode's verify needs
+        results[name] = {'error': repr(e)}
+    if 'error' in results[name]:
+        print("%-40s %s" % (name, results[name]['error']))
+    else:
+        print("%-40s %10.1fus x %d" % (name, results[name]['mean_us'], ops))
+
+###############################################################################
+
+def bench_codec(results, ops=500):
+    bolt11 = encode_bolt11(1000, "benchmark", 3600, PAYMENT_HASH, DATE)
+    hrp, data = bech32.bech32_decode(bolt11)
+    template = Bolt11Template()
+    template.encode(1000, "benchmark", 3600, PAYMENT_HASH, DATE)
+
+    _bench(results, 'codec/lnencode',
+           lambda n: encode_bolt11(1000 + n, "benchmark", 3600,
+                                   PAYMENT_HASH, DATE), ops)
+    _bench(results, 'codec/template_miss',
+           lambda n: template.encode(2000 + n, "benchmark", 3600,
+                                     PAYMENT_HASH, DATE), ops)
+    _bench(results, 'codec/template_hit',
+           lambda n: template.encode(1000, "benchmark", 3600,
+                                     PAYMENT_HASH, DATE), ops)
+    _bench(results, 'codec/lndecode',
+           lambda n: lndecode(bolt11), ops)
+    _bench(results, 'codec/lndecode_noverify',
+           lambda n: lndecode(bolt11, verify=False), ops)
+    _bench(results, 'codec/bech32_encode',
+           lambda n: bech32.bech32_encode(hrp, data), ops)
+    _bench(results, 'codec/bech32_decode',
+           lambda n: bech32.bech32_decode(bolt11), ops)
+
+###############################################################################
+
+def _new_daemon(backend, scratch):
+    for f in os.listdir(scratch):
+        path = os.path.join(scratch, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+    if backend == 'memory':
+        return MockDaemon(True)
+    return MockDaemon(False, backend=backend)
+
+
+def _populate(daemon, size):
+    # Placeholder bolt11s: filling the state isn't what's being measured.
+    now = daemon._get_time()
+    for n in range(size):
+        daemon.state.add_invoice(
+            Invoice("fill%d" % n, MOCK_BOLT11,
+                    hashlib.sha256(n.to_bytes(8, 'big')).digest(), 1000,
+                    now + 3600))
+    daemon.state.write_state()
+
+
+def _ops(size, most=50):
+    # fewer repetitions where each one rewrites a big state
+    return max(3, min(most, 200000 // size))
+
+
+def bench_commands(results, backend, size, scratch):
+    daemon = _new_daemon(backend, scratch)
+    start = time.perf_counter()
+    _populate(daemon, size)
+    print("%-40s %10.3fs" % ("%s/%d/populate" % (backend, size),
+                             time.perf_counter() - start))
+    prefix = "%s/%d/" % (backend, size)
+    ops = _ops(size)
+
+    specs = os.path.join(scratch, "specs.jsonl")
+    with open(specs, 'w') as f:
+        for n in range(100):
+            f.write(json.dumps({'msatoshi': 1000, 'label': "batch%d" % n,
+                                'description': "benchmark"}) + "\n")
+    export = os.path.join(scratch, "export.json")
+
+    _bench(results, prefix + 'invoice',
+           lambda n: daemon.run_cmd(['invoice', '1000', "new%d" % n,
+                                     "benchmark", '3600', PREIMAGE]), ops)
+    # only the in-memory state can leave the bolt11s unsigned for good
+    daemon.lazy_bolt11 = True
+    _bench(results, prefix + 'invoice_lazy',
+           lambda n: daemon.run_cmd(['invoice', '1000', "lazy%d" % n,
+                                     "benchmark", '3600', PREIMAGE]), ops)
+    daemon.lazy_bolt11 = False
+    _bench(results, prefix + 'invoicebatch',
+           lambda n: daemon.run_cmd(['invoicebatch', specs,
+                                     '--workers', '1']), 1)
+    _bench(results, prefix + 'listinvoices',
+           lambda n: daemon.run_cmd(['listinvoices']), _ops(size, 10))
+    _bench(results, prefix + 'listinvoices_label',
+           lambda n: daemon.run_cmd(['listinvoices', '--label',
+                                     "fill%d" % n]), ops)
+    _bench(results, prefix + 'markpaid',
+           lambda n: daemon.run_cmd(['markpaid', "fill%d" % n]), ops)
+    _bench(results, prefix + 'delinvoice',
+           lambda n: daemon.run_cmd(['delinvoice', "fill%d" % n, 'paid']),
+           ops)
+    _bench(results, prefix + 'advancetime',
+           lambda n: daemon.run_cmd(['advancetime', '1']), ops)
+    _bench(results, prefix + 'autocleaninvoice',
+           lambda n: daemon.run_cmd(['autocleaninvoice', '--cycle-seconds',
+                                     '1', '--expired-by', '1']), ops)
+    _bench(results, prefix + 'exportstate',
+           lambda n: daemon.run_cmd(['exportstate', export]), _ops(size, 10))
+    _bench(results, prefix + 'reset',
+           lambda n: daemon.run_cmd(['reset']), 1)
+    daemon.close()
+
+###############################################################################
+
+def run(args):
+    results = {}
+    bench_codec(results)
+    scratch = tempfile.mkdtemp(prefix="mock-c-lightning-bench")
+    # keep the benchmark away from the real state files
+    mock_c_lightning.set_state_dir(scratch)
+    try:
+        for size in args.sizes:
+            for backend in args.backends:
+                bench_commands(results, backend, size, scratch)
+    finally:
+        shutil.rmtree(scratch)
+    _write_results(results, args)
+
+
+def startup(args):
+    results = {}
+    scratch = tempfile.mkdtemp(prefix="mock-c-lightning-bench")
+    env = dict(os.environ, TMPDIR=scratch)
+    try:
+        for backend in args.backends:
+            env['MOCK_C_LIGHTNING_BACKEND'] = backend
+            for name, argv in STARTUP_COMMANDS:
+                _bench(results, "startup/%s/%s" % (backend, name),
+                       lambda n: subprocess.run(
+                           [sys.executable, SCRIPT] + argv(n), env=env,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True),
+                       args.runs)
+    finally:
+        shutil.rmtree(scratch)
+    _write_results(results, args)
+
+
+def _write_results(results, args):
+    output = {'meta':    {'python':   platform.python_version(),
+                          'machine':  platform.machine(),
+                          'speedups': bech32.HAVE_SPEEDUPS,
+                          'date':     int(time.time())},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        report(baseline, output, args.threshold)
+
+
+def regressions(baseline, current, threshold):
+    """ (name, baseline us, current us) for every benchmark more than
+    threshold (a fraction) slower than in baseline. """
+    slower = []
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if not base or 'mean_us' not in base or 'mean_us' not in result:
+            continue
+        if result['mean_us'] > base['mean_us'] * (1 + threshold):
+            slower.append((name, base['mean_us'], result['mean_us']))
+    return slower
+
+
+def report(baseline, current, threshold):
+    slower = regressions(baseline, current, threshold)
+    for name, base, cur in slower:
+        print("%-40s %10.1fus -> %10.1fus (%+.0f%%)" %
+              (name, base, cur, (cur / base - 1) * 100))
+    if slower:
+        sys.exit("*** %d benchmarks regressed by more than %.0f%%" %
+                 (len(slower), threshold * 100))
+    print("no regressions beyond %.0f%%" % (threshold * 100))
+
+
+def compare(args):
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r') as f:
+        current = json.load(f)
+    report(baseline, current, args.threshold)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='mock c-lightning benchmarks')
+    subparsers = parser.add_subparsers(dest='subparser_name')
+
+    parser_run = subparsers.add_parser('run', help='run the benchmarks')
+    parser_run.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                            help=('invoices in the state before timing the '
+                                  'commands (default %s)' %
+                                  " ".join(str(s) for s in SIZES)))
+    parser_run.add_argument('--backends', nargs='+', default=BACKENDS,
+                            choices=BACKENDS,
+                            help='state backends to time the commands on')
+    parser_run.add_argument('--output', help='JSON file to write results to')
+    parser_run.add_argument('--baseline',
+                            help='JSON results to check for regressions')
+    parser_run.add_argument('--threshold', type=float, default=THRESHOLD,
+                            help=('slowdown counted as a regression, as a '
+                                  'fraction (default %s)' % THRESHOLD))
+    parser_run.set_defaults(cmd=run)
+
+    parser_startup = subparsers.add_parser('startup',
+                                           help=('time CLI invocations of '
+                                                 'each subcommand'))
+    parser_startup.add_argument('--runs', type=int, default=20,
+                                help='invocations of each (default 20)')
+    parser_startup.add_argument('--backends', nargs='+', default=['json'],
+                                choices=BACKENDS[1:],
+                                help='state backends (default json)')
+    parser_startup.add_argument('--output',
+                                help='JSON file to write results to')
+    parser_startup.add_argument('--baseline',
+                                help='JSON results to check for regressions')
+    parser_startup.add_argument('--threshold', type=float, default=THRESHOLD,
+                                help=('slowdown counted as a regression, as '
+                                      'a fraction (default %s)' % THRESHOLD))
+    parser_startup.set_defaults(cmd=startup)
+
+    parser_compare = subparsers.add_parser('compare',
+                                           help=('check stored results '
+                                                 'against a baseline'))
+    parser_compare.add_argument('baseline', help='baseline JSON results')
+    parser_compare.add_argument('current', help='JSON results to check')
+    parser_compare.add_argument('--threshold', type=float, default=THRESHOLD,
+                                help=('slowdown counted as a regression, as '
+                                      'a fraction (default %s)' % THRESHOLD))
+    parser_compare.set_defaults(cmd=compare)
+
+    args = parser.parse_args()
+    if not args.subparser_name:
+        parser.print_help()
+        sys.exit(1)
+    args.cmd(args)
@@ -134,6 +134,22 @@ class CliMockDaemon(Daemon):
             return None, err.decode('utf8')
         return None, None
 
+    def wait_any_invoice(self, lastpay_index=0):
+        path = self.settings.lightning_rpc
+        cmd = [path, 'waitanyinvoice', str(lastpay_index)]
+        code, out, err = get_exitcode_stdout_stderr(cmd)
+        if code != 0:
+            return None, err.decode('utf8')
+        return json.loads(out.decode('utf8')), None
+
+    def wait_invoice(self, label):
+        path = self.settings.lightning_rpc
+        cmd = [path, 'waitinvoice', label]
+        code, out, err = get_exitcode_stdout_stderr(cmd)
+        if code != 0:
+            return None, err.decode('utf8')
+        return json.loads(out.decode('utf8')), None
+
 
 ###############################################################################
 
@@ -149,40 +165,41 @@ class MemMockDaemon(Daemon):
     def invoice_c_lightning(self, msatoshi, label, description, expiry,
                             preimage):
         print("invoice mem mock")
-        cmd = ['invoice', str(msatoshi), label, description,
-               str(expiry), preimage]
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.invoice(int(msatoshi), label, description,
+                                     int(expiry), preimage)
         return output, None
 
     def get_c_lightning_invoices(self):
-        cmd = ['listinvoices']
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.listinvoices()
         return output['invoices'], None
 
     def reset(self):
-        cmd = ['reset']
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.reset()
         return output, None
 
     def autoclean(self):
-        cmd = ['autocleaninvoice', '--cycle-seconds', '60',
-               '--expired-by', '10']
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.autocleaninvoice(cycle_seconds=60,
+                                              expired_by=10)
         return output, None
 
     def advance_time(self, seconds):
-        cmd = ['advancetime', str(seconds)]
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.advancetime(int(seconds))
         return output, None
 
     def mark_paid(self, label):
-        cmd = ['markpaid', label]
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.markpaid(label)
         return output, None
 
     def delete(self, label, state='paid'):
-        cmd = ['delinvoice', label, state]
-        output = self.daemon.run_cmd(cmd)
+        output = self.daemon.delinvoice(label, state)
+        return output, None
+
+    def wait_any_invoice(self, lastpay_index=0):
+        output = self.daemon.waitanyinvoice(int(lastpay_index))
+        return output, None
+
+    def wait_invoice(self, label):
+        output = self.daemon.waitinvoice(label)
         return output, None
 
 
@@ -223,3 +240,17 @@ class RealDaemon(Daemon):
             return None, "c-lightning delinvoice exception"
         print(json.dumps(result, indent=1, sort_keys=True))
         return result, None
+
+    def wait_any_invoice(self, lastpay_index=0):
+        try:
+            result = self.rpc.waitanyinvoice(lastpay_index)
+        except:
+            return None, "c-lightning waitanyinvoice exception"
+        return result, None
+
+    def wait_invoice(self, label):
+        try:
+            result = self.rpc.waitinvoice(label)
+        except:
+            return None, "c-lightning waitinvoice exception"
+        return result, None
@@ -0,0 +1,431 @@
+/*
+ * C versions of the hot bech32 and 5-bit conversion functions. The pure
+ * Python ones in bech32.py and lnaddr.py are replaced by these when the
+ * module has been built (python3 -m lightning_payencode.build_ext), and
+ * must give the same results for every valid input.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+static const char CHARSET[] = "qpzry9x8gf2tvdw0s3jn54khce6mua7l";
+
+static const uint32_t GENERATOR[5] = {
+    0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3
+};
+
+static int8_t charset_rev[128];
+
+static uint32_t
+polymod_step(uint32_t chk, uint8_t value)
+{
+    uint32_t top = chk >> 25;
+    int i;
+
+    chk = ((chk & 0x1ffffff) << 5) ^ value;
+    for (i = 0; i < 5; i++)
+        if ((top >> i) & 1)
+            chk ^= GENERATOR[i];
+    return chk;
+}
+
+static uint32_t
+polymod_hrp(uint32_t chk, const char *hrp, Py_ssize_t len)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < len; i++)
+        chk = polymod_step(chk, (uint8_t)hrp[i] >> 5);
+    chk = polymod_step(chk, 0);
+    for (i = 0; i < len; i++)
+        chk = polymod_step(chk, (uint8_t)hrp[i] & 31);
+    return chk;
+}
+
+/* Copies a sequence of 5-bit values into a new buffer, or fails with
+ * ValueError if any is out of range. */
+static uint8_t *
+u5_from_seq(PyObject *seq, Py_ssize_t *len, Py_ssize_t extra)
+{
+    PyObject *fast, **items;
+    uint8_t *out;
+    Py_ssize_t i, n;
+
+    fast = PySequence_Fast(seq, "expected a sequence of 5-bit values");
+    if (fast == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(fast);
+    items = PySequence_Fast_ITEMS(fast);
+    out = PyMem_Malloc(n + extra + 1);
+    if (out == NULL) {
+        Py_DECREF(fast);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    for (i = 0; i < n; i++) {
+        long v = PyLong_AsLong(items[i]);
+        if (v == -1 && PyErr_Occurred())
+            goto fail;
+        if (v < 0 || v > 31) {
+            PyErr_Format(PyExc_ValueError, "%ld is not a 5-bit value", v);
+            goto fail;
+        }
+        out[i] = (uint8_t)v;
+    }
+    Py_DECREF(fast);
+    *len = n;
+    return out;
+
+fail:
+    Py_DECREF(fast);
+    PyMem_Free(out);
+    return NULL;
+}
+
+static PyObject *
+u5_to_list(const uint8_t *values, Py_ssize_t len)
+{
+    PyObject *list = PyList_New(len);
+    Py_ssize_t i;
+
+    if (list == NULL)
+        return NULL;
+    for (i = 0; i < len; i++)
+        /* small ints are cached, so this never fails */
+        PyList_SET_ITEM(list, i, PyLong_FromLong(values[i]));
+    return list;
+}
+
+/*****************************************************************************/
+
+static PyObject *
+bech32_polymod(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"values", "chk", NULL};
+    PyObject *seq;
+    unsigned long chk = 1;
+    uint8_t *values;
+    Py_ssize_t i, n;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|k:bech32_polymod",
+                                     kwlist, &seq, &chk))
+        return NULL;
+    if (chk >> 30) {
+        PyErr_SetString(PyExc_ValueError, "chk must fit in 30 bits");
+        return NULL;
+    }
+    values = u5_from_seq(seq, &n, 0);
+    if (values == NULL)
+        return NULL;
+    for (i = 0; i < n; i++)
+        chk = polymod_step((uint32_t)chk, values[i]);
+    PyMem_Free(values);
+    return PyLong_FromUnsignedLong(chk);
+}
+
+static PyObject *
+bech32_encode(PyObject *self, PyObject *args)
+{
+    const char *hrp;
+    Py_ssize_t hrp_len, n, i;
+    PyObject *seq, *result;
+    uint8_t *data;
+    uint32_t chk;
+    char *out;
+
+    if (!PyArg_ParseTuple(args, "s#O:bech32_encode", &hrp, &hrp_len, &seq))
+        return NULL;
+    for (i = 0; i < hrp_len; i++) {
+        if ((uint8_t)hrp[i] > 127) {
+            PyErr_SetString(PyExc_ValueError, "hrp must be ASCII");
+            return NULL;
+        }
+    }
+    data = u5_from_seq(seq, &n, 6);
+    if (data == NULL)
+        return NULL;
+
+    chk = polymod_hrp(1, hrp, hrp_len);
+    for (i = 0; i < n; i++)
+        chk = polymod_step(chk, data[i]);
+    for (i = 0; i < 6; i++)
+        chk = polymod_step(chk, 0);
+    chk ^= 1;
+    for (i = 0; i < 6; i++)
+        data[n + i] = (chk >> (5 * (5 - i))) & 31;
+
+    out = PyMem_Malloc(hrp_len + 1 + n + 6);
+    if (out == NULL) {
+        PyMem_Free(data);
+        return PyErr_NoMemory();
+    }
+    memcpy(out, hrp, hrp_len);
+    out[hrp_len] = '1';
+    for (i = 0; i < n + 6; i++)
+        out[hrp_len + 1 + i] = CHARSET[data[i]];
+    result = PyUnicode_DecodeASCII(out, hrp_len + 1 + n + 6, NULL);
+    PyMem_Free(out);
+    PyMem_Free(data);
+    return result;
+}
+
+static PyObject *
+bech32_decode(PyObject *self, PyObject *arg)
+{
+    const char *bech;
+    Py_ssize_t len, pos, i, n;
+    int has_lower = 0, has_upper = 0;
+    PyObject *hrp_obj, *data_obj, *result;
+    uint8_t *data;
+    char *lower;
+    uint32_t chk;
+
+    if (!PyUnicode_Check(arg)) {
+        PyErr_SetString(PyExc_TypeError, "bech32_decode() expects a str");
+        return NULL;
+    }
+    if (!PyUnicode_IS_ASCII(arg))
+        return Py_BuildValue("(OO)", Py_None, Py_None);
+    bech = PyUnicode_AsUTF8AndSize(arg, &len);
+    if (bech == NULL)
+        return NULL;
+
+    pos = -1;
+    for (i = 0; i < len; i++) {
+        char c = bech[i];
+        if (c < 33 || c > 126)
+            return Py_BuildValue("(OO)", Py_None, Py_None);
+        if (c >= 'a' && c <= 'z')
+            has_lower = 1;
+        else if (c >= 'A' && c <= 'Z')
+            has_upper = 1;
+        if (c == '1')
+            pos = i;
+    }
+    if ((has_lower && has_upper) || pos < 1 || pos + 7 > len)
+        return Py_BuildValue("(OO)", Py_None, Py_None);
+
+    lower = PyMem_Malloc(len);
+    data = PyMem_Malloc(len);
+    if (lower == NULL || data == NULL) {
+        PyMem_Free(lower);
+        PyMem_Free(data);
+        return PyErr_NoMemory();
+    }
+    for (i = 0; i < len; i++) {
+        char c = bech[i];
+        lower[i] = (c >= 'A' && c <= 'Z') ? c + ('a' - 'A') : c;
+    }
+    n = len - pos - 1;
+    chk = polymod_hrp(1, lower, pos);
+    for (i = 0; i < n; i++) {
+        int8_t v = charset_rev[(uint8_t)lower[pos + 1 + i]];
+        if (v < 0)
+            break;
+        data[i] = (uint8_t)v;
+        chk = polymod_step(chk, data[i]);
+    }
+    if (i < n || chk != 1) {
+        PyMem_Free(lower);
+        PyMem_Free(data);
+        return Py_BuildValue("(OO)", Py_None, Py_None);
+    }
+
+    hrp_obj = PyUnicode_DecodeASCII(lower, pos, NULL);
+    data_obj = u5_to_list(data, n - 6);
+    PyMem_Free(lower);
+    PyMem_Free(data);
+    if (hrp_obj == NULL || data_obj == NULL) {
+        Py_XDECREF(hrp_obj);
+        Py_XDECREF(data_obj);
+        return NULL;
+    }
+    result = PyTuple_Pack(2, hrp_obj, data_obj);
+    Py_DECREF(hrp_obj);
+    Py_DECREF(data_obj);
+    return result;
+}
+
+static PyObject *
+convertbits(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"data", "frombits", "tobits", "pad", NULL};
+    PyObject *seq, *fast, **items, *ret, *v;
+    int frombits, tobits, pad = 1;
+    uint64_t acc = 0, maxv, max_acc;
+    int bits = 0;
+    Py_ssize_t i, n;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Oii|p:convertbits",
+                                     kwlist, &seq, &frombits, &tobits, &pad))
+        return NULL;
+    if (frombits < 1 || tobits < 1 || frombits + tobits > 64) {
+        PyErr_SetString(PyExc_ValueError,
+                        "frombits + tobits must be at most 64");
+        return NULL;
+    }
+    maxv = (((uint64_t)1) << tobits) - 1;
+    max_acc = (((uint64_t)1) << (frombits + tobits - 1)) - 1;
+
+    fast = PySequence_Fast(seq, "expected a sequence of integers");
+    if (fast == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(fast);
+    items = PySequence_Fast_ITEMS(fast);
+    ret = PyList_New(0);
+    if (ret == NULL)
+        goto fail;
+    for (i = 0; i < n; i++) {
+        int overflow;
+        long long value = PyLong_AsLongLongAndOverflow(items[i], &overflow);
+        if (value == -1 && PyErr_Occurred())
+            goto fail;
+        if (overflow || value < 0 || (value >> frombits))
+            goto invalid;
+        acc = ((acc << frombits) | (uint64_t)value) & max_acc;
+        bits += frombits;
+        while (bits >= tobits) {
+            bits -= tobits;
+            v = PyLong_FromUnsignedLongLong((acc >> bits) & maxv);
+            if (v == NULL || PyList_Append(ret, v) < 0) {
+                Py_XDECREF(v);
+                goto fail;
+            }
+            Py_DECREF(v);
+        }
+    }
+    if (pad) {
+        if (bits) {
+            v = PyLong_FromUnsignedLongLong((acc << (tobits - bits)) & maxv);
+            if (v == NULL || PyList_Append(ret, v) < 0) {
+                Py_XDECREF(v);
+                goto fail;
+            }
+            Py_DECREF(v);
+        }
+    } else if (bits >= frombits || ((acc << (tobits - bits)) & maxv)) {
+        goto invalid;
+    }
+    Py_DECREF(fast);
+    return ret;
+
+invalid:
+    Py_DECREF(fast);
+    Py_DECREF(ret);
+    Py_RETURN_NONE;
+
+fail:
+    Py_DECREF(fast);
+    Py_XDECREF(ret);
+    return NULL;
+}
+
+static PyObject *
+bytes_to_u5(PyObject *self, PyObject *arg)
+{
+    Py_buffer view;
+    const uint8_t *b;
+    uint8_t *out;
+    Py_ssize_t i, n, nbits;
+    uint32_t acc = 0;
+    int bits = 0;
+    PyObject *result;
+
+    if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    b = view.buf;
+    nbits = view.len * 8;
+    out = PyMem_Malloc((nbits + 4) / 5 + 1);
+    if (out == NULL) {
+        PyBuffer_Release(&view);
+        return PyErr_NoMemory();
+    }
+    n = 0;
+    for (i = 0; i < view.len; i++) {
+        acc = ((acc << 8) | b[i]) & 0xfff;
+        bits += 8;
+        while (bits >= 5) {
+            bits -= 5;
+            out[n++] = (acc >> bits) & 31;
+        }
+    }
+    if (bits)
+        out[n++] = (acc << (5 - bits)) & 31;
+    PyBuffer_Release(&view);
+    result = u5_to_list(out, n);
+    PyMem_Free(out);
+    return result;
+}
+
+static PyObject *
+u5_to_bytes(PyObject *self, PyObject *arg)
+{
+    uint8_t *values, *out;
+    Py_ssize_t i, n, len;
+    uint32_t acc = 0;
+    int bits = 0;
+    PyObject *result;
+
+    values = u5_from_seq(arg, &n, 0);
+    if (values == NULL)
+        return NULL;
+    out = PyMem_Malloc((n * 5 + 7) / 8 + 1);
+    if (out == NULL) {
+        PyMem_Free(values);
+        return PyErr_NoMemory();
+    }
+    len = 0;
+    for (i = 0; i < n; i++) {
+        acc = ((acc << 5) | values[i]) & 0xfff;
+        bits += 5;
+        if (bits >= 8) {
+            bits -= 8;
+            out[len++] = (acc >> bits) & 0xff;
+        }
+    }
+    if (bits)
+        out[len++] = (acc << (8 - bits)) & 0xff;
+    result = PyBytes_FromStringAndSize((const char *)out, len);
+    PyMem_Free(out);
+    PyMem_Free(values);
+    return result;
+}
+
+/*****************************************************************************/
+
+static PyMethodDef methods[] = {
+    {"bech32_polymod", (PyCFunction)(void (*)(void))bech32_polymod,
+     METH_VARARGS | METH_KEYWORDS,
+     "Internal function that computes the Bech32 checksum."},
+    {"bech32_encode", bech32_encode, METH_VARARGS,
+     "Compute a Bech32 string given HRP and data values."},
+    {"bech32_decode", bech32_decode, METH_O,
+     "Validate a Bech32 string, and determine HRP and data."},
+    {"convertbits", (PyCFunction)(void (*)(void))convertbits,
+     METH_VARARGS | METH_KEYWORDS,
+     "General power-of-2 base conversion."},
+    {"bytes_to_u5", bytes_to_u5, METH_O,
+     "Bytes as 5-bit groups, zero-padding the last group"},
+    {"u5_to_bytes", u5_to_bytes, METH_O,
+     "5-bit groups packed into bytes, zero-padding the last byte"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "_bech32",
+    "C versions of the hot bech32 and 5-bit conversion functions.",
+    -1, methods
+};
+
+PyMODINIT_FUNC
+PyInit__bech32(void)
+{
+    int i;
+
+    memset(charset_rev, -1, sizeof(charset_rev));
+    for (i = 0; i < 32; i++)
+        charset_rev[(uint8_t)CHARSET[i]] = (int8_t)i;
+    return PyModule_Create(&module);
+}
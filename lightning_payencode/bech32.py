@@ -21,18 +21,42 @@
 """Reference implementation for Bech32 and segwit addresses."""
 
 
+import functools
+
+
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
 
+GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
 
-def bech32_polymod(values):
-    """Internal function that computes the Bech32 checksum."""
-    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
-    chk = 1
+
+def _bech32_polymod_reference(values, chk=1):
+    """Bit-by-bit checksum computation, as in the BIP173 reference."""
     for value in values:
         top = chk >> 25
         chk = (chk & 0x1ffffff) << 5 ^ value
         for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+            chk ^= GENERATOR[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+# The checksum is linear, so the effect of the top bits of the running
+# value can be looked up: the top 10 bits when consuming two symbols at a
+# time, or the top 5 for a single trailing one.
+_POLYMOD_TABLE2 = [_bech32_polymod_reference([0, 0], top << 20)
+                   for top in range(1024)]
+_POLYMOD_TABLE1 = [_bech32_polymod_reference([0], top << 25)
+                   for top in range(32)]
+
+
+def bech32_polymod(values, chk=1):
+    """Internal function that computes the Bech32 checksum."""
+    table2 = _POLYMOD_TABLE2
+    it = iter(values)
+    for a, b in zip(it, it):
+        chk = ((chk & 0xfffff) << 10) ^ table2[chk >> 20] ^ (a << 5) ^ b
+    if len(values) % 2:
+        chk = (((chk & 0x1ffffff) << 5) ^ _POLYMOD_TABLE1[chk >> 25] ^
+               values[-1])
     return chk
 
 
@@ -41,15 +65,26 @@ def bech32_hrp_expand(hrp):
     return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
 
 
+@functools.lru_cache(maxsize=64)
+def _hrp_polymod(hrp):
+    """Checksum state after the expanded HRP, which is shared by every
+    string with that prefix (eg. 'lnbc')."""
+    return bech32_polymod(bech32_hrp_expand(hrp))
+
+
 def bech32_verify_checksum(hrp, data):
     """Verify a checksum given HRP and converted data characters."""
-    return bech32_polymod(bech32_hrp_expand(hrp) + data) == 1
+    return bech32_polymod(data, _hrp_polymod(hrp)) == 1
 
 
 def bech32_create_checksum(hrp, data):
     """Compute the checksum values given HRP and data."""
-    values = bech32_hrp_expand(hrp) + data
-    polymod = bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
+    chk = bech32_polymod(data, _hrp_polymod(hrp))
+    # followed by six zero symbols
+    table2 = _POLYMOD_TABLE2
+    for _ in range(3):
+        chk = ((chk & 0xfffff) << 10) ^ table2[chk >> 20]
+    polymod = chk ^ 1
     return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
 
 
@@ -59,6 +94,9 @@ def bech32_encode(hrp, data):
     return hrp + '1' + ''.join([CHARSET[d] for d in combined])
 
 
+_CHARSET_REV = {c: i for i, c in enumerate(CHARSET)}
+
+
 def bech32_decode(bech):
     """Validate a Bech32 string, and determine HRP and data."""
     if ((any(ord(x) < 33 or ord(x) > 126 for x in bech)) or
@@ -68,10 +106,11 @@ def bech32_decode(bech):
     pos = bech.rfind('1')
     if pos < 1 or pos + 7 > len(bech): #or len(bech) > 90:
         return (None, None)
-    if not all(x in CHARSET for x in bech[pos+1:]):
+    try:
+        data = [_CHARSET_REV[x] for x in bech[pos+1:]]
+    except KeyError:
         return (None, None)
     hrp = bech[:pos]
-    data = [CHARSET.find(x) for x in bech[pos+1:]]
     if not bech32_verify_checksum(hrp, data):
         return (None, None)
     return (hrp, data[:-6])
@@ -121,3 +160,20 @@ def encode(hrp, witver, witprog):
     assert decode(hrp, ret) is not (None, None)
     return ret
 
+
+# The pure Python versions of the functions _bech32 can replace, kept for
+# checking it against (see build_ext).
+PURE_PYTHON = {
+    'bech32_polymod': bech32_polymod,
+    'bech32_encode': bech32_encode,
+    'bech32_decode': bech32_decode,
+    'convertbits': convertbits,
+}
+
+try:
+    from lightning_payencode._bech32 import (bech32_polymod, bech32_encode,
+                                             bech32_decode, convertbits)
+    HAVE_SPEEDUPS = True
+except ImportError:
+    HAVE_SPEEDUPS = False
+
@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+"""
+Builds the optional _bech32 C extension in place and checks it against the
+pure Python code it replaces:
+
+    python3 -m lightning_payencode.build_ext          # build, then check
+    python3 -m lightning_payencode.build_ext --check  # just check
+
+Without the extension everything falls back to the pure Python versions.
+"""
+
+import os
+import sys
+import random
+import tempfile
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# BIP173 test vectors, plus a few BOLT11 strings.
+VALID = [
+    "A12UEL5L",
+    "a12uel5l",
+    "an83characterlonghumanreadablepartthatcontainsthenumber1andtheexcludedcharactersbio1tt5tgs",
+    "abcdef1qpzry9x8gf2tvdw0s3jn54khce6mua7lmqqqxw",
+    "11qqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqqc8247j",
+    "split1checkupstagehandshakeupstreamerranterredcaperred2y9e3w",
+    "?1ezyfcl",
+    "BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4",
+    "tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7",
+    "bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7k7grplx",
+    "lnbc1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpl2pkx2ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxaq8rkx3yf5tcsyz3d73gafnh3cax9rn449d9p5uxz9ezhhypd0elx87sjle52x86fux2ypatgddc6k63n7erqz25le42c4u4ecky03ylcqca784w",
+    "lnbc2500u1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7enxv4jsxqzpuaztrnwngzn3kdzw5hydlzf03qdgm2hdq27cqv3agm2awhz5se903vruatfhq77w3ls4evs3ch9zw97j25emudupq63nyw24cg27h2rspfj9srp",
+]
+
+INVALID = [
+    "\x201nwldj5",
+    "\x7f1axkwrx",
+    "\x801eym55h",
+    "pzry9x0s0muk",
+    "1pzry9x0s0muk",
+    "x1b4n0q5v",
+    "li1dgmt3",
+    "de1lg7wt\xff",
+    "A1G7SGD8",
+    "10a06t8",
+    "1qzzfhee",
+    "Bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5",
+    "lnbc1qqqqqqq",
+]
+
+
+def build():
+    from setuptools import Distribution, Extension
+    from setuptools.command.build_ext import build_ext
+    ext = Extension('lightning_payencode._bech32',
+                    [os.path.join(HERE, '_bech32.c')],
+                    extra_compile_args=['-O2'])
+    dist = Distribution({'ext_modules': [ext]})
+    cmd = build_ext(dist)
+    cmd.inplace = True
+    cmd.build_temp = tempfile.mkdtemp()
+    cmd.ensure_finalized()
+    # inplace puts the module next to the package it belongs to
+    os.chdir(os.path.dirname(HERE))
+    cmd.run()
+
+
+def _vectors(rng):
+    """ (function name, args) pairs shared by both implementations """
+    for s in VALID + INVALID:
+        yield 'bech32_decode', (s,)
+        yield 'bech32_decode', (s.swapcase(),)
+    for n in [0, 1, 2, 3, 7, 52, 104, 500, 1500]:
+        data = [rng.randrange(32) for _ in range(n)]
+        raw = bytes(rng.randrange(256) for _ in range(n))
+        for hrp in ['a', 'bc', 'lnbc', 'lnbc2500u', 'lntb10n']:
+            yield 'bech32_encode', (hrp, data)
+        yield 'bech32_polymod', (data,)
+        yield 'bech32_polymod', (data, rng.randrange(2**30))
+        yield 'bytes_to_u5', (raw,)
+        yield 'u5_to_bytes', (data,)
+        yield 'convertbits', (data, 5, 8)
+        yield 'convertbits', (data, 5, 8, False)
+        yield 'convertbits', (list(raw), 8, 5)
+        yield 'convertbits', (list(raw), 8, 5, False)
+        yield 'convertbits', (list(raw) + [256], 8, 5)
+
+
+def check(count=200, seed=0):
+    """ Runs the extension and the pure Python code over the same vectors;
+    returns the mismatches. """
+    from lightning_payencode import bech32, lnaddr, _bech32
+    pure = dict(bech32.PURE_PYTHON, **lnaddr.PURE_PYTHON)
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(count):
+        for name, args in _vectors(rng):
+            expected = pure[name](*args)
+            got = getattr(_bech32, name)(*args)
+            if name == 'bech32_decode' and expected[0] is not None:
+                # checksum round trip
+                if bech32.bech32_encode(*got) != args[0].lower():
+                    mismatches.append(('round trip', args))
+            if got != expected:
+                mismatches.append((name, args, expected, got))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="build the _bech32 C extension and check it")
+    parser.add_argument('--check', action='store_true',
+                        help="only check an already built extension")
+    args = parser.parse_args()
+    if not args.check:
+        build()
+    mismatches = check()
+    for m in mismatches[:10]:
+        print(m)
+    if mismatches:
+        sys.exit("*** %d mismatches against the pure Python code" %
+                 len(mismatches))
+    print("_bech32 matches the pure Python code")
@@ -1,11 +1,10 @@
 #! /usr/bin/env python3
 from lightning_payencode.bech32 import bech32_encode, bech32_decode, CHARSET
 from binascii import hexlify, unhexlify
-from bitstring import BitArray
 from decimal import Decimal
 
 import base58
-import bitstring
+import functools
 import hashlib
 import math
 import re
@@ -59,20 +58,40 @@ def unshorten_amount(amount):
     else:
         return Decimal(amount)
 
-# Bech32 spits out array of 5-bit values.  Shim here.
-def u5_to_bitarray(arr):
-    ret = bitstring.BitArray()
+# Bech32 spits out array of 5-bit values. Both directions work on plain
+# lists of them, converted with integer shifts.
+def int_to_u5(value, count):
+    """ Big-endian 5-bit groups of value, exactly count of them """
+    return [(value >> (5 * i)) & 31 for i in range(count - 1, -1, -1)]
+
+def bytes_to_u5(b):
+    """ Bytes as 5-bit groups, zero-padding the last group """
+    nbits = len(b) * 8
+    pad = -nbits % 5
+    return int_to_u5(int.from_bytes(b, 'big') << pad, (nbits + pad) // 5)
+
+def u5_to_bytes(arr):
+    """ 5-bit groups packed into bytes, zero-padding the last byte """
+    value = u5_to_int(arr)
+    nbits = len(arr) * 5
+    pad = -nbits % 8
+    return (value << pad).to_bytes((nbits + pad) // 8, 'big')
+
+def u5_to_int(arr):
+    value = 0
     for a in arr:
-        ret += bitstring.pack("uint:5", a)
-    return ret
+        value = (value << 5) | a
+    return value
 
-def bitarray_to_u5(barr):
-    assert barr.len % 5 == 0
-    ret = []
-    s = bitstring.ConstBitStream(barr)
-    while s.pos != s.len:
-        ret.append(s.read(5).uint)
-    return ret
+PURE_PYTHON = {
+    'bytes_to_u5': bytes_to_u5,
+    'u5_to_bytes': u5_to_bytes,
+}
+
+try:
+    from lightning_payencode._bech32 import bytes_to_u5, u5_to_bytes
+except ImportError:
+    pass
 
 def encode_fallback(fallback, currency):
     """ Encode all supported fallback addresses.
@@ -85,7 +104,7 @@ def encode_fallback(fallback, currency):
             wver = witness[0]
             if wver > 16:
                 raise ValueError("Invalid witness version {}".format(witness[0]))
-            wprog = u5_to_bitarray(witness[1:])
+            wprog = witness[1:]
         else:
             addr = base58.b58decode_check(fallback)
             if is_p2pkh(currency, addr[0]):
@@ -94,26 +113,28 @@ def encode_fallback(fallback, currency):
                 wver = 18
             else:
                 raise ValueError("Unknown address type for {}".format(currency))
-            wprog = addr[1:]
-        return tagged('f', bitstring.pack("uint:5", wver) + wprog)
+            wprog = bytes_to_u5(addr[1:])
+        return tagged('f', [wver] + wprog)
     else:
         raise NotImplementedError("Support for currency {} not implemented".format(currency))
 
 def parse_fallback(fallback, currency):
     if currency == 'bc' or currency == 'tb':
-        wver = fallback[0:5].uint
+        if not fallback:
+            return None
+        wver = fallback[0]
         if wver == 17:
             addr=base58.b58encode_check(bytes([base58_prefix_map[currency][0]])
-                                        + fallback[5:].tobytes())
+                                        + u5_to_bytes(fallback[1:]))
         elif wver == 18:
             addr=base58.b58encode_check(bytes([base58_prefix_map[currency][1]])
-                                        + fallback[5:].tobytes())
+                                        + u5_to_bytes(fallback[1:]))
         elif wver <= 16:
-            addr=bech32_encode(currency, bitarray_to_u5(fallback))
+            addr=bech32_encode(currency, fallback)
         else:
             return None
     else:
-        addr=fallback.tobytes()
+        addr=u5_to_bytes(fallback)
     return addr
 
 
@@ -129,34 +150,46 @@ def is_p2pkh(currency, prefix):
 def is_p2sh(currency, prefix):
     return prefix == base58_prefix_map[currency][1]
 
-# Tagged field containing BitArray
+# Tagged field containing 5-bit values
 def tagged(char, l):
-    # Tagged fields need to be zero-padded to 5 bits.
-    while l.len % 5 != 0:
-        l.append('0b0')
-    return bitstring.pack("uint:5, uint:5, uint:5",
-                          CHARSET.find(char),
-                          (l.len / 5) / 32, (l.len / 5) % 32) + l
+    if len(l) >= 1024:
+        raise ValueError("Field '{}' is too long to encode".format(char))
+    return [CHARSET.find(char), len(l) >> 5, len(l) & 31] + l
 
 # Tagged field containing bytes
 def tagged_bytes(char, l):
-    return tagged(char, bitstring.BitArray(l))
+    return tagged(char, bytes_to_u5(l))
 
 # Discard trailing bits, convert to bytes.
-def trim_to_bytes(barr):
+def trim_to_bytes(arr):
     # Adds a byte if necessary.
-    b = barr.tobytes()
-    if barr.len % 8 != 0:
+    b = u5_to_bytes(arr)
+    if len(arr) * 5 % 8 != 0:
         return b[:-1]
     return b
 
-# Try to pull out tagged data: returns tag, tagged data and remainder.
-def pull_tagged(stream):
-    tag = stream.read(5).uint
-    length = stream.read(5).uint * 32 + stream.read(5).uint
-    return (CHARSET[tag], stream.read(length * 5), stream)
+# Try to pull out tagged data: returns tag, tagged data and the position
+# after it.
+def pull_tagged(data, pos):
+    if pos + 3 > len(data):
+        raise ValueError("Truncated tagged field")
+    tag = data[pos]
+    length = data[pos + 1] * 32 + data[pos + 2]
+    end = pos + 3 + length
+    if end > len(data):
+        raise ValueError("Truncated tagged field")
+    return (CHARSET[tag], data[pos + 3:end], end)
+
+@functools.lru_cache(None)
+def get_signer(privkey):
+    """ A secp256k1.PrivateKey for the hex privkey, built once per key.
+    Each PrivateKey sets up its own libsecp256k1 context, which costs more
+    than the signing itself. """
+    return secp256k1.PrivateKey(bytes(unhexlify(privkey)))
 
 def lnencode(addr, privkey):
+    """ privkey is either the hex private key or a signer (a
+    secp256k1.PrivateKey, eg. from get_signer()). """
     if addr.amount:
         amount = Decimal(str(addr.amount))
         # We can only send down to millisatoshi.
@@ -171,7 +204,9 @@ def lnencode(addr, privkey):
     hrp = 'ln' + amount
 
     # Start with the timestamp
-    data = bitstring.pack('uint:35', addr.date)
+    if not 0 <= addr.date < 2**35:
+        raise ValueError("Cannot encode timestamp {}".format(addr.date))
+    data = int_to_u5(addr.date, 7)
 
     # Payment hash
     data += tagged_bytes('p', addr.paymenthash)
@@ -187,21 +222,24 @@ def lnencode(addr, privkey):
                 raise ValueError("Duplicate '{}' tag".format(k))
 
         if k == 'r':
-            route = bitstring.BitArray()
+            route = b''
             for step in v:
                 pubkey, channel, feebase, feerate, cltv = step
-                route.append(bitstring.BitArray(pubkey) + bitstring.BitArray(channel) + bitstring.pack('intbe:32', feebase) + bitstring.pack('intbe:32', feerate) + bitstring.pack('intbe:16', cltv))
-            data += tagged('r', route)
+                route += (bytes(pubkey) + bytes(channel) +
+                          feebase.to_bytes(4, 'big', signed=True) +
+                          feerate.to_bytes(4, 'big', signed=True) +
+                          cltv.to_bytes(2, 'big', signed=True))
+            data += tagged_bytes('r', route)
         elif k == 'f':
             data += encode_fallback(v, addr.currency)
         elif k == 'd':
             data += tagged_bytes('d', v.encode())
         elif k == 'x':
-            # Get minimal length by trimming leading 5 bits at a time.
-            expirybits = bitstring.pack('intbe:64', v)[4:64]
-            while expirybits.startswith('0b00000'):
-                expirybits = expirybits[5:]
-            data += tagged('x', expirybits)
+            # Minimal length: no leading zero 5-bit groups, from at most 60
+            # bits.
+            expiry = int(v) & (2**60 - 1)
+            data += tagged('x', int_to_u5(expiry,
+                                          (expiry.bit_length() + 4) // 5))
         elif k == 'h':
             data += tagged_bytes('h', hashlib.sha256(v.encode('utf-8')).digest())
         elif k == 'n':
@@ -222,13 +260,15 @@ def lnencode(addr, privkey):
         raise ValueError("Must include either 'd' or 'h'")
     
     # We actually sign the hrp, then data (padded to 8 bits with zeroes).
-    privkey = secp256k1.PrivateKey(bytes(unhexlify(privkey)))
-    sig = privkey.ecdsa_sign_recoverable(bytearray([ord(c) for c in hrp]) + data.tobytes())
+    if not isinstance(privkey, secp256k1.PrivateKey):
+        privkey = get_signer(privkey)
+    sig = privkey.ecdsa_sign_recoverable(hrp.encode('ascii') + u5_to_bytes(data))
     # This doesn't actually serialize, but returns a pair of values :(
     sig, recid = privkey.ecdsa_recoverable_serialize(sig)
-    data += bytes(sig) + bytes([recid])
+    # 65 bytes is 104 5-bit groups exactly, so no padding is added here.
+    data += bytes_to_u5(bytes(sig) + bytes([recid]))
 
-    return bech32_encode(hrp, bitarray_to_u5(data))
+    return bech32_encode(hrp, data)
 
 class LnAddr(object):
     def __init__(self, paymenthash=None, amount=None, currency='bc', tags=None, date=None):
@@ -248,7 +288,11 @@ class LnAddr(object):
             ", ".join([k + '=' + str(v) for k, v in self.tags])
         )
 
-def lndecode(a, verbose=False):
+def lndecode(a, verbose=False, verify=True):
+    """ Decode a BOLT11 string into an LnAddr. With verify=False the
+    signature is neither checked nor used to recover the pubkey (which is
+    left as None), skipping secp256k1 entirely for callers that only want
+    the invoice fields. """
     hrp, data = bech32_decode(a)
     if not hrp:
         raise ValueError("Bad bech32 checksum")
@@ -259,13 +303,11 @@ def lndecode(a, verbose=False):
     if not hrp.startswith('ln'):
         raise ValueError("Does not start with ln")
 
-    data = u5_to_bitarray(data);
-
-    # Final signature 65 bytes, split it off.
-    if len(data) < 65*8:
+    # Final signature 65 bytes (104 5-bit groups), split it off.
+    if len(data) < 104:
         raise ValueError("Too short to contain signature")
-    sigdecoded = data[-65*8:].tobytes()
-    data = bitstring.ConstBitStream(data[:-65*8])
+    sigdecoded = u5_to_bytes(data[-104:])
+    data = data[:-104]
 
     addr = LnAddr()
     addr.pubkey = None
@@ -282,18 +324,21 @@ def lndecode(a, verbose=False):
         if amountstr != '':
             addr.amount = unshorten_amount(amountstr)
 
-    addr.date = data.read(35).uint
+    if len(data) < 7:
+        raise ValueError("Too short to contain timestamp")
+    addr.date = u5_to_int(data[:7])
 
-    while data.pos != data.len:
-        tag, tagdata, data = pull_tagged(data)
+    pos = 7
+    while pos != len(data):
+        tag, tagdata, pos = pull_tagged(data, pos)
 
         # BOLT #11:
         #
         # A reader MUST skip over unknown fields, an `f` field with unknown
         # `version`, or a `p`, `h`, or `n` field which does not have
         # `data_length` 52, 52, or 53 respectively.
-        data_length = len(tagdata) / 5
-        
+        data_length = len(tagdata)
+
         if tag == 'r':
             # BOLT #11:
             #
@@ -306,14 +351,14 @@ def lndecode(a, verbose=False):
             #    * `feerate` (32 bits, big-endian)
             #    * `cltv_expiry_delta` (16 bits, big-endian)
             route=[]
-            s = bitstring.ConstBitStream(tagdata)
-            while s.pos + 264 + 64 + 32 + 32 + 16 < s.len:
-                route.append((s.read(264).tobytes(),
-                              s.read(64).tobytes(),
-                              s.read(32).intbe,
-                              s.read(32).intbe,
-                              s.read(16).intbe))
-            addr.tags.append(('r',route))                
+            b = u5_to_bytes(tagdata)
+            for s in range(0, data_length * 5 // 408 * 51, 51):
+                route.append((b[s:s + 33],
+                              b[s + 33:s + 41],
+                              int.from_bytes(b[s + 41:s + 45], 'big', signed=True),
+                              int.from_bytes(b[s + 45:s + 49], 'big', signed=True),
+                              int.from_bytes(b[s + 49:s + 51], 'big', signed=True)))
+            addr.tags.append(('r',route))
         elif tag == 'f':
             fallback = parse_fallback(tagdata, addr.currency)
             if fallback:
@@ -333,7 +378,7 @@ def lndecode(a, verbose=False):
             addr.tags.append(('h', trim_to_bytes(tagdata)))
 
         elif tag == 'x':
-            addr.tags.append(('x', tagdata.uint))
+            addr.tags.append(('x', u5_to_int(tagdata)))
 
         elif tag == 'p':
             if data_length != 52:
@@ -345,19 +390,25 @@ def lndecode(a, verbose=False):
             if data_length != 53:
                 addr.unknown_tags.append((tag, tagdata))
                 continue
-            addr.pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
-            addr.pubkey.deserialize(trim_to_bytes(tagdata))
+            if verify:
+                addr.pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
+                addr.pubkey.deserialize(trim_to_bytes(tagdata))
         else:
             addr.unknown_tags.append((tag, tagdata))
 
+    # The signature covers the hrp, then data (padded to 8 bits with zeroes).
+    signed = hrp.encode('ascii') + u5_to_bytes(data)
+
     if verbose:
         print('hex of signature data (32 byte r, 32 byte s): {}'
               .format(hexlify(sigdecoded[0:64])))
         print('recovery flag: {}'.format(sigdecoded[64]))
         print('hex of data for signing: {}'
-              .format(hexlify(bytearray([ord(c) for c in hrp])
-                              + data.tobytes())))
-        print('SHA256 of above: {}'.format(hashlib.sha256(bytearray([ord(c) for c in hrp]) + data.tobytes()).hexdigest()))
+              .format(hexlify(signed)))
+        print('SHA256 of above: {}'.format(hashlib.sha256(signed).hexdigest()))
+
+    if not verify:
+        return addr
 
     # BOLT #11:
     #
@@ -369,13 +420,13 @@ def lndecode(a, verbose=False):
         # A reader MUST use the `n` field to validate the signature instead of
         # performing signature recovery if a valid `n` field is provided.
         addr.signature = addr.pubkey.ecdsa_deserialize_compact(sigdecoded[0:64])
-        if not addr.pubkey.ecdsa_verify(bytearray([ord(c) for c in hrp]) + data.tobytes(), addr.signature):
+        if not addr.pubkey.ecdsa_verify(signed, addr.signature):
             raise ValueError('Invalid signature')
     else: # Recover pubkey from signature.
         addr.pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
         addr.signature = addr.pubkey.ecdsa_recoverable_deserialize(
             sigdecoded[0:64], sigdecoded[64])
         addr.pubkey.public_key = addr.pubkey.ecdsa_recover(
-            bytearray([ord(c) for c in hrp]) + data.tobytes(), addr.signature)
+            signed, addr.signature)
 
     return addr
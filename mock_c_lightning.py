@@ -7,11 +7,54 @@ import json
 import time
 import tempfile
 import hashlib
+import heapq
+import bisect
+import fcntl
+import functools
+import itertools
+import threading
+import collections.abc
 
 from binascii import unhexlify
-from lightning_payencode.lnaddr import lnencode, LnAddr
 
-STATE_FILE = os.path.join(tempfile.gettempdir(), "mock-c-lightning-state.json")
+# The BOLT11 stack (lightning_payencode, and through it secp256k1, base58,
+# decimal and the bech32 tables), sqlite3 and concurrent.futures are only
+# imported where they're used, so that CLI commands which don't sign
+# anything or use the sqlite backend start without loading them.
+
+def set_state_dir(path):
+    """ Puts all the state files in directory path, where CLI invocations
+    run with TMPDIR=path find them too. """
+    global STATE_FILE, JOURNAL_FILE, LOCK_FILE, STATS_FILE, WAITERS_DIR
+    global SQLITE_FILE
+    STATE_FILE = os.path.join(path, "mock-c-lightning-state.json")
+    JOURNAL_FILE = STATE_FILE + ".journal"
+    LOCK_FILE = STATE_FILE + ".lock"
+    STATS_FILE = STATE_FILE + ".stats"
+    # CLI invocations blocked in waitanyinvoice/waitinvoice each listen on a
+    # unix socket in here for word that the state changed; see FileWaiter.
+    WAITERS_DIR = STATE_FILE + ".waiters"
+    SQLITE_FILE = os.path.join(path, "mock-c-lightning-state.sqlite")
+
+
+set_state_dir(tempfile.gettempdir())
+
+# How the state is persisted between invocations:
+#   'json'    - rewrite STATE_FILE as pretty JSON after every change
+#   'journal' - append a compact record per change to JOURNAL_FILE, folding it
+#               into a compact STATE_FILE snapshot once it grows past
+#               JOURNAL_COMPACT_BYTES
+#   'sqlite'  - keep everything in SQLITE_FILE
+STATE_BACKEND = os.environ.get("MOCK_C_LIGHTNING_BACKEND", "json")
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+
+# CLI invocations that wait longer than this for the state lock say so on
+# stderr; regular waits mean the callers would be better off with 'serve'.
+LOCK_WAIT_REPORT_SECONDS = 0.01
+
+# With MOCK_C_LIGHTNING_STATS=1, commands are timed (see CommandStats). CLI
+# invocations add theirs to STATS_FILE, for 'getstats' to report.
+STATS_ENABLED = os.environ.get("MOCK_C_LIGHTNING_STATS", "") == "1"
 
 # This key is used as the private key for signing the invoices. Security isn't
 # the goal in this application, so it is fine to use any old number.
@@ -23,18 +66,309 @@ MSATOSHIS_PER_BTC = SATOSHIS_PER_BTC * 1000
 # for scale testing bolt11s take a noticeable chunk of time to encode. If it
 # isn't important that it be correct , we can short-circuit and just return a
 # placeholder.
+
 MOCK_BOLT11 = "lnbc50n1pdm373mpp50hlcjdrcm9u3qqqs4a926g63d3t5qwyndytqjjgknskuvmd9kc2sdz2d4shyapwwpujq6twwehkjcm9ypnx7u3qxys8q6tcv4k8xtpqw4ek2ujlwd68y6twvuazqg3zyqxqzjcuvzstexcj4zcz7ldtkwz8t5pdsghauyhkdqdxccx8ts3ta023xqzwgwxuvlu9eehh97d0qcu9k5a4u2glenrekp7w9sswydl4hneyjqqzkxf54"
 
+# With template_bolt11, this many of the most recently encoded bolt11s are
+# remembered, so re-issuing the same invoice skips signing altogether.
+BOLT11_CACHE_SIZE = 4096
+
+# invoicebatch only starts a process pool to sign bolt11s for batches at
+# least this big; below that the pool's startup costs more than it saves.
+BATCH_POOL_MIN = 64
+
+###############################################################################
+
+def encode_bolt11(msatoshi, description, expiry, payment_hash, date,
+                  signer=None):
+    from decimal import Decimal
+    from lightning_payencode.lnaddr import lnencode, LnAddr, get_signer
+    addr = LnAddr()
+    addr.currency = 'bc'
+    addr.failback = None
+    # exactly; a float loses the low digits of big amounts
+    addr.amount = Decimal(msatoshi) / MSATOSHIS_PER_BTC
+    addr.date = date
+    addr.paymenthash = unhexlify(payment_hash)
+    addr.tags.append(('d', description))
+    addr.tags.append(('x', str(expiry)))
+    return lnencode(addr, signer or get_signer(SIGNING_KEY))
+
+def _encode_bolt11_params(params):
+    # for ProcessPoolExecutor.map(), which passes a single argument
+    return encode_bolt11(*params)
+
+
+class Bolt11Template(object):
+    """ Encodes the same bolt11s as encode_bolt11(), but only the date and
+    payment hash are encoded afresh for each one. The HRP and the d and x
+    fields are cached, and whole bolt11s are memoized by their inputs. """
+    def __init__(self, signer=None, cache_size=BOLT11_CACHE_SIZE):
+        from lightning_payencode import lnaddr
+        self.lnaddr = lnaddr
+        self.signer = signer or lnaddr.get_signer(SIGNING_KEY)
+        self.encode = functools.lru_cache(cache_size)(self._encode)
+
+    @staticmethod
+    @functools.lru_cache(256)
+    def _hrp(msatoshi):
+        from decimal import Decimal
+        from lightning_payencode.lnaddr import shorten_amount
+        if not msatoshi:
+            return 'lnbc'
+        return 'lnbc' + shorten_amount(Decimal(msatoshi) / MSATOSHIS_PER_BTC)
+
+    @staticmethod
+    @functools.lru_cache(256)
+    def _description(description):
+        from lightning_payencode.lnaddr import tagged_bytes
+        return tagged_bytes('d', description.encode())
+
+    @staticmethod
+    @functools.lru_cache(256)
+    def _expiry(expiry):
+        from lightning_payencode.lnaddr import tagged, int_to_u5
+        expiry = int(expiry) & (2**60 - 1)
+        return tagged('x', int_to_u5(expiry, (expiry.bit_length() + 4) // 5))
+
+    def _encode(self, msatoshi, description, expiry, payment_hash, date):
+        lnaddr = self.lnaddr
+        hrp = self._hrp(msatoshi)
+        data = (lnaddr.int_to_u5(date, 7) +
+                lnaddr.tagged_bytes('p', unhexlify(payment_hash)) +
+                self._description(description) + self._expiry(expiry))
+        sig = self.signer.ecdsa_sign_recoverable(hrp.encode('ascii') +
+                                                 lnaddr.u5_to_bytes(data))
+        sig, recid = self.signer.ecdsa_recoverable_serialize(sig)
+        return lnaddr.bech32_encode(hrp, data +
+                                    lnaddr.bytes_to_u5(sig + bytes([recid])))
+
+
+@functools.lru_cache(None)
+def bolt11_template(signer=None):
+    # one per signer, shared so the memoized bolt11s outlive any one
+    # MockDaemon
+    return Bolt11Template(signer)
+
+###############################################################################
+
+class Invoice(object):
+    """
+    An invoice as the state keeps it: a fixed set of slots rather than a
+    dict, with the status as a small integer, the payment hash as its 32
+    raw bytes and each of the duplicated timestamps stored once. to_json()
+    gives the dict shape c-lightning outputs (and state files hold), and is
+    only called when an invoice is written out or returned.
+
+    The bolt11 may be a LazyBolt11 instead of a string, in which case it is
+    signed, and kept, the first time it is read.
+    """
+    __slots__ = ('label', '_bolt11', 'payment_hash', 'msatoshi', 'status',
+                 'expires_at', 'paid_at', 'msatoshi_received', 'pay_index')
+
+    UNPAID, PAID, EXPIRED = range(3)
+    STATUSES = ('unpaid', 'paid', 'expired')
+    STATUS_CODES = {name: code for code, name in enumerate(STATUSES)}
+
+    def __init__(self, label, bolt11, payment_hash, msatoshi, expires_at,
+                 status=UNPAID, paid_at=None, msatoshi_received=None,
+                 pay_index=None):
+        self.label = label
+        self._bolt11 = bolt11
+        self.payment_hash = payment_hash
+        self.msatoshi = msatoshi
+        self.status = status
+        self.expires_at = expires_at
+        self.paid_at = paid_at
+        self.msatoshi_received = msatoshi_received
+        self.pay_index = pay_index
+
+    @property
+    def bolt11(self):
+        bolt11 = self._bolt11
+        if bolt11.__class__ is LazyBolt11:
+            bolt11 = self._bolt11 = bolt11.sign(self)
+        return bolt11
+
+    @property
+    def bolt11_signed(self):
+        return self._bolt11.__class__ is not LazyBolt11
+
+    @classmethod
+    def from_json(cls, i):
+        return cls(i['label'], i['bolt11'], bytes.fromhex(i['payment_hash']),
+                   i['msatoshi'], i['expires_at'],
+                   cls.STATUS_CODES[i['status']], i.get('paid_at'),
+                   i.get('msatoshi_recieved'), i.get('pay_index'))
+
+    def to_json(self):
+        i = {'label':        self.label,
+             'bolt11':       self.bolt11,
+             'payment_hash': self.payment_hash.hex(),
+             'msatoshi':     self.msatoshi,
+             'status':       self.STATUSES[self.status],
+             'expires_at':   self.expires_at,
+             'expiry_time':  self.expires_at}
+        if self.pay_index is not None:
+            i['paid_at'] = self.paid_at
+            i['paid_timestamp'] = self.paid_at
+            # (sic), as c-lightning spelled it
+            i['msatoshi_recieved'] = self.msatoshi_received
+            i['pay_index'] = self.pay_index
+        return i
+
+    def update(self, fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def fields_to_json(cls, fields):
+        # changed fields, as in the journal and the sqlite columns
+        json_fields = {}
+        for name, value in fields.items():
+            if name == 'status':
+                json_fields['status'] = cls.STATUSES[value]
+            elif name == 'paid_at':
+                json_fields['paid_at'] = value
+                json_fields['paid_timestamp'] = value
+            elif name == 'msatoshi_received':
+                json_fields['msatoshi_recieved'] = value
+            else:
+                json_fields[name] = value
+        return json_fields
+
+    @classmethod
+    def fields_from_json(cls, json_fields):
+        fields = {}
+        for name, value in json_fields.items():
+            if name == 'status':
+                fields['status'] = cls.STATUS_CODES[value]
+            elif name == 'msatoshi_recieved':
+                fields['msatoshi_received'] = value
+            elif name not in ('paid_timestamp', 'expiry_time'):
+                fields[name] = value
+        return fields
+
+
+class LazyBolt11(object):
+    """ Stands in for the bolt11 of an invoice made with lazy_bolt11: what
+    it takes to sign it besides what the Invoice holds anyway (its date is
+    expires_at - expiry). """
+    __slots__ = ('daemon', 'description', 'expiry')
+
+    def __init__(self, daemon, description, expiry):
+        self.daemon = daemon
+        self.description = description
+        self.expiry = expiry
+
+    def sign(self, i):
+        # timed as part of whichever command reads it first
+        return self.daemon._phase('sign', self.daemon._encoder(), i.msatoshi,
+                                  self.description, self.expiry,
+                                  i.payment_hash.hex(),
+                                  i.expires_at - self.expiry)
+
+
+class InvoiceOutput(collections.abc.MutableMapping):
+    """
+    The response to invoice for an invoice whose bolt11 isn't signed yet.
+    It is a mapping rather than a dict, so that every read, write or copy
+    of it goes through the methods below, and the first one fills in
+    'bolt11' from the invoice; a caller that never looks at the response
+    never pays for signing. json.dumps() needs dict(response), or
+    default=dict as the RPC server passes.
+    """
+    __slots__ = ('invoice', 'output')
+
+    def __init__(self, invoice, output):
+        self.invoice = invoice
+        self.output = output
+
+    def _signed(self):
+        if self.invoice is not None:
+            self.output['bolt11'] = self.invoice.bolt11
+            self.invoice = None
+        return self.output
+
+    def __getitem__(self, key):
+        return self._signed()[key]
+
+    def __setitem__(self, key, value):
+        self._signed()[key] = value
+
+    def __delitem__(self, key):
+        del self._signed()[key]
+
+    def __iter__(self):
+        return iter(self._signed())
+
+    def __len__(self):
+        return len(self.output)
+
+    def copy(self):
+        return dict(self._signed())
+
+    def __repr__(self):
+        return repr(self._signed())
+
 ###############################################################################
 
 class DaemonState(dict):
-    def __init__(self, in_memory):
+    """
+    Daemon state. Invoices are kept out of the dict itself in an
+    insertion-ordered store keyed by label, with a second index keyed by
+    pay_index, and two heaps ordered by expiry: one of unpaid invoices
+    waiting to expire and one of expired invoices waiting to be autocleaned.
+    They are flattened back into the 'invoices' list only when the state
+    is serialized.
+
+    Every change goes through __setitem__ or the invoice methods below so
+    that it marks the state dirty and, in journal mode, can be recorded and
+    later replayed on top of the last snapshot. write_state() only writes
+    a dirty state, and with a write_behind interval (in seconds) it writes
+    at most once per interval; flush() writes out whatever is outstanding.
+
+    With lock=True an exclusive lock on LOCK_FILE is taken before the state
+    is read and held until close(), so concurrent CLI invocations each get a
+    consistent read-modify-write instead of losing each other's updates.
+    """
+    def __init__(self, in_memory, journal=False, write_behind=0, lock=False):
         super().__init__()
         self.in_memory = in_memory
+        self.journal = journal
+        self.write_behind = write_behind
+        self.last_flush = None
+        self.dirty = False
+        self.pending = None
+        self.lock_file = None
+        self.lock_wait = 0.0
+        if lock and not in_memory:
+            self.lock()
         if in_memory:
-            self.update(DaemonState.empty_state())
+            self._load(DaemonState.empty_state())
         else:
-            self.update(DaemonState.read_state())
+            self._load(DaemonState.read_state())
+            self._replay_journal()
+            if journal:
+                self.pending = []
+
+    def lock(self):
+        f = open(LOCK_FILE, 'a')
+        start = time.monotonic()
+        fcntl.flock(f, fcntl.LOCK_EX)
+        self.lock_wait = time.monotonic() - start
+        self.lock_file = f
+
+    def unlock(self):
+        if not self.lock_file:
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def close(self):
+        self.flush()
+        self.unlock()
 
     @staticmethod
     def empty_state():
@@ -42,6 +376,9 @@ class DaemonState(dict):
                 'autoclean_cycle_seconds': 0,
                 'autoclean_last_clean':    None,
                 'autoclean_expired_by':    86400,
+                'autoclean_cycle_cleaned': 0,
+                'autoclean_total_cleaned': 0,
+                'next_pay_index':          1,
                 'invoices':                []}
 
     @staticmethod
@@ -53,81 +390,852 @@ class DaemonState(dict):
             return json.loads(content)
         return DaemonState.empty_state()
 
-    def write_state(self):
-        if self.in_memory:
+    @staticmethod
+    def _migrate(state):
+        # state files written before the pay_index counter was persisted
+        if 'next_pay_index' not in state:
+            i_list = [i['pay_index'] for i in state['invoices']
+                      if i['status'] == 'paid']
+            current_max = max(i_list) if len(i_list) > 0 else 0
+            state['next_pay_index'] = current_max + 1
+        state.setdefault('autoclean_cycle_cleaned', 0)
+        state.setdefault('autoclean_total_cleaned', 0)
+        return state
+
+    def _load(self, state):
+        state = DaemonState._migrate(state)
+        invoices = state.pop('invoices')
+        self.clear()
+        self.update(state)
+        self.by_label = {}
+        self.by_pay_index = {}
+        self.expiry_heap = []
+        self.expired_heap = []
+        for i in invoices:
+            self._insert(Invoice.from_json(i))
+
+    def serialize(self):
+        state = dict(self)
+        state['invoices'] = [i.to_json() for i in self.iter_invoices()]
+        return state
+
+    def export(self, path):
+        f = open(path, 'w')
+        f.write(json.dumps(self.serialize(), sort_keys=True, indent=1))
+        f.close()
+
+    ###########################################################################
+
+    def _record(self, record):
+        self.dirty = True
+        if self.pending is not None:
+            self.pending.append(record)
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'set':
+            dict.__setitem__(self, record['key'], record['value'])
+        elif op == 'add':
+            self._insert(Invoice.from_json(record['invoice']))
+        elif op == 'update':
+            i = self.by_label.get(record['label'])
+            if i:
+                self._update(i, Invoice.fields_from_json(record['fields']))
+        elif op == 'del':
+            if record['label'] in self.by_label:
+                self._delete(record['label'])
+        elif op == 'reset':
+            self._load(DaemonState.empty_state())
+
+    def _replay_journal(self):
+        if not os.path.exists(JOURNAL_FILE):
             return
-        f = open(STATE_FILE, 'w')
-        f.write(json.dumps(self, sort_keys=True, indent=1))
+        f = open(JOURNAL_FILE, 'rb+')
+        good = 0
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("no newline")
+                record = json.loads(line)
+            except ValueError:
+                # A record cut short by a crash mid-append. Cut it off, or
+                # the next append would be glued onto it and lost with it.
+                f.truncate(good)
+                break
+            self._apply(record)
+            good += len(line)
+        f.close()
+
+    def _write_snapshot(self, indent):
+        content = json.dumps(self.serialize(), sort_keys=True, indent=indent,
+                             separators=None if indent else (',', ':'))
+        # write alongside and rename over, so a reader or a crash never sees
+        # a partially written file
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(STATE_FILE),
+                                   dir=os.path.dirname(STATE_FILE))
+        f = os.fdopen(fd, 'w')
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.replace(tmp, STATE_FILE)
+        # everything in the journal is now in the snapshot
+        if os.path.exists(JOURNAL_FILE):
+            os.unlink(JOURNAL_FILE)
+
+    def _append_journal(self):
+        f = open(JOURNAL_FILE, 'a')
+        f.write(''.join(json.dumps(r, separators=(',', ':')) + "\n"
+                        for r in self.pending))
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+        f.close()
+        if size > JOURNAL_COMPACT_BYTES:
+            self._write_snapshot(None)
+
+    def flush(self):
+        if self.in_memory or not self.dirty:
+            return
+        if self.journal:
+            self._append_journal()
+            self.pending = []
+        else:
+            self._write_snapshot(1)
+        self.dirty = False
+        self.last_flush = time.monotonic()
+
+    def write_state(self):
+        if self.in_memory or not self.dirty:
+            return
+        if (self.write_behind and self.last_flush is not None and
+                time.monotonic() - self.last_flush < self.write_behind):
+            # leave it for a later write_state() or flush()
+            return
+        self.flush()
+
+    def reset(self):
+        self._load(DaemonState.empty_state())
+        self._record({'op': 'reset'})
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._record({'op': 'set', 'key': key, 'value': value})
+
+    ###########################################################################
+
+    def iter_invoices(self, status=None, after_pay_index=None, offset=0,
+                      limit=None):
+        """ Invoices in the order they were created or, with
+        after_pay_index, those paid after that one in the order they were
+        paid. Optionally only those with the given status (an Invoice
+        status code), and a page of limit of them after skipping offset. """
+        if after_pay_index is None:
+            invoices = iter(self.by_label.values())
+        else:
+            by_pay_index = self.by_pay_index
+            invoices = (by_pay_index[n]
+                        for n in range(after_pay_index + 1,
+                                       self['next_pay_index'])
+                        if n in by_pay_index)
+        if status is not None:
+            invoices = (i for i in invoices if i.status == status)
+        if offset or limit is not None:
+            invoices = itertools.islice(invoices, offset,
+                                        None if limit is None
+                                        else offset + limit)
+        return invoices
+
+    def get_invoice(self, label):
+        return self.by_label.get(label)
+
+    def _insert(self, i):
+        self.by_label[i.label] = i
+        if i.pay_index is not None:
+            self.by_pay_index[i.pay_index] = i
+        if i.status == Invoice.UNPAID:
+            heapq.heappush(self.expiry_heap, (i.expires_at, i.label))
+        elif i.status == Invoice.EXPIRED:
+            heapq.heappush(self.expired_heap, (i.expires_at, i.label))
+
+    def _update(self, i, fields):
+        if 'pay_index' in fields and i.pay_index is not None:
+            # paid again
+            self.by_pay_index.pop(i.pay_index, None)
+        i.update(fields)
+        if 'pay_index' in fields:
+            self.by_pay_index[i.pay_index] = i
+        if fields.get('status') == Invoice.EXPIRED:
+            heapq.heappush(self.expired_heap, (i.expires_at, i.label))
+
+    def _delete(self, label):
+        i = self.by_label.pop(label)
+        if i.pay_index is not None:
+            del self.by_pay_index[i.pay_index]
+        return i
+
+    def add_invoice(self, i):
+        self._insert(i)
+        # only a journal needs the invoice as JSON (which signs a lazy bolt11)
+        self._record({'op': 'add',
+                      'invoice': (i.to_json() if self.pending is not None
+                                  else None)})
+
+    def update_invoice(self, i, fields):
+        # fields are Invoice attributes; the journal gets them as JSON
+        self._update(i, fields)
+        self._record({'op': 'update', 'label': i.label,
+                      'fields': Invoice.fields_to_json(fields)})
+
+    def remove_invoice(self, label):
+        i = self._delete(label)
+        self._record({'op': 'del', 'label': label})
+        return i
+
+    def expire_invoices(self, now):
+        # Entries for invoices that were paid or deleted since they were
+        # pushed are left in the heap and skipped here when they surface.
+        expired = 0
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            expires_at, label = heapq.heappop(self.expiry_heap)
+            i = self.by_label.get(label)
+            if not i or i.status != Invoice.UNPAID:
+                continue
+            if i.expires_at != expires_at:
+                continue
+            self.update_invoice(i, {'status': Invoice.EXPIRED})
+            expired += 1
+        return expired
+
+    def clean_expired(self, now, expired_by):
+        # Deletes invoices that have been expired for at least expired_by
+        # seconds, oldest first, stopping at the first one that hasn't.
+        cleaned = 0
+        while (self.expired_heap and
+               now - self.expired_heap[0][0] >= expired_by):
+            expires_at, label = heapq.heappop(self.expired_heap)
+            i = self.by_label.get(label)
+            if not i or i.status != Invoice.EXPIRED:
+                continue
+            if i.expires_at != expires_at:
+                continue
+            self.remove_invoice(label)
+            cleaned += 1
+        return cleaned
+
+    def allocate_pay_index(self):
+        # like c-lightning, pay indexes are never reused, even after the
+        # paid invoice is deleted
+        pay_index = self['next_pay_index']
+        self['next_pay_index'] = pay_index + 1
+        return pay_index
+
+###############################################################################
+
+class SqliteDaemonState(DaemonState):
+    """
+    Daemon state kept in a SQLite database, for invoice counts where
+    holding everything in Python structures or a JSON file stops scaling.
+    Invoice lookups, expiry and autoclean are indexed queries. The database
+    is in WAL mode so the CLI can read it while a server process writes.
+    Changes are committed by write_state().
+    """
+    INVOICE_COLUMNS = ('label', 'bolt11', 'payment_hash', 'msatoshi',
+                       'status', 'expires_at', 'expiry_time', 'paid_at',
+                       'paid_timestamp', 'msatoshi_recieved', 'pay_index')
+
+    def __init__(self, in_memory, write_behind=0, lock=False):
+        dict.__init__(self)
+        self.in_memory = in_memory
+        self.journal = False
+        self.write_behind = write_behind
+        self.last_flush = None
+        self.dirty = False
+        self.pending = None
+        self.lock_file = None
+        self.lock_wait = 0.0
+        if lock and not in_memory:
+            self.lock()
+        import sqlite3
+        # waitanyinvoice/waitinvoice may read it from another thread
+        self.db = sqlite3.connect(':memory:' if in_memory else SQLITE_FILE,
+                                  timeout=30, check_same_thread=False)
+        if not in_memory:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        rows = self.db.execute("SELECT key, value FROM meta").fetchall()
+        if rows:
+            dict.update(self, ((k, json.loads(v)) for k, v in rows))
+        else:
+            for key, value in DaemonState.empty_state().items():
+                if key != 'invoices':
+                    self[key] = value
+            self.db.commit()
+        self._select = ("SELECT %s FROM invoices" %
+                        ", ".join(self.INVOICE_COLUMNS))
+
+    def _create_tables(self):
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT);
+            CREATE TABLE IF NOT EXISTS invoices (
+                id                INTEGER PRIMARY KEY,
+                label             TEXT NOT NULL UNIQUE,
+                bolt11            TEXT,
+                payment_hash      TEXT,
+                msatoshi          INTEGER,
+                status            TEXT,
+                expires_at        INTEGER,
+                expiry_time       INTEGER,
+                paid_at           INTEGER,
+                paid_timestamp    INTEGER,
+                msatoshi_recieved INTEGER,
+                pay_index         INTEGER);
+            CREATE INDEX IF NOT EXISTS invoices_status_expires_at
+                ON invoices (status, expires_at);
+            CREATE INDEX IF NOT EXISTS invoices_pay_index
+                ON invoices (pay_index);
+            """)
+
+    def _row_to_invoice(self, row):
+        (label, bolt11, payment_hash, msatoshi, status, expires_at, _,
+         paid_at, _, msatoshi_received, pay_index) = row
+        return Invoice(label, bolt11, bytes.fromhex(payment_hash), msatoshi,
+                       expires_at, Invoice.STATUS_CODES[status], paid_at,
+                       msatoshi_received, pay_index)
+
+    def _query_one(self, where, params):
+        row = self.db.execute(self._select + " WHERE " + where,
+                              params).fetchone()
+        return self._row_to_invoice(row) if row else None
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                        "VALUES (?, ?)", (key, json.dumps(value)))
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            self._end_idle_transaction()
+            return
+        self.db.commit()
+        self.dirty = False
+        self.last_flush = time.monotonic()
+
+    def write_state(self):
+        if not self.dirty:
+            self._end_idle_transaction()
+        super().write_state()
+
+    def _end_idle_transaction(self):
+        # sqlite3 opens a transaction before any UPDATE or DELETE, even one
+        # that changes nothing (eg. expiring when nothing has expired). Left
+        # open, it would hold the database's write lock against every other
+        # process.
+        if self.db.in_transaction:
+            self.db.commit()
+
+    def close(self):
+        super().close()
+        self.db.close()
 
     def reset(self):
-        self.update(DaemonState.empty_state())
+        self.db.execute("DELETE FROM invoices")
+        self.db.execute("DELETE FROM meta")
+        self.dirty = True
+        dict.clear(self)
+        for key, value in DaemonState.empty_state().items():
+            if key != 'invoices':
+                self[key] = value
+
+    ###########################################################################
+
+    def iter_invoices(self, status=None, after_pay_index=None, offset=0,
+                      limit=None):
+        where = []
+        params = []
+        if status is not None:
+            where.append("status = ?")
+            params.append(Invoice.STATUSES[status])
+        if after_pay_index is not None:
+            where.append("pay_index > ?")
+            params.append(after_pay_index)
+        query = self._select
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += (" ORDER BY id" if after_pay_index is None else
+                  " ORDER BY pay_index")
+        if offset or limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+        cursor = self.db.execute(query, params)
+        return (self._row_to_invoice(row) for row in cursor)
+
+    def get_invoice(self, label):
+        return self._query_one("label = ?", (label,))
+
+    def add_invoice(self, i):
+        i = i.to_json()
+        columns = [c for c in self.INVOICE_COLUMNS if c in i]
+        self.db.execute("INSERT INTO invoices (%s) VALUES (%s)" %
+                        (", ".join(columns), ", ".join("?" * len(columns))),
+                        [i[c] for c in columns])
+        self.dirty = True
+
+    def update_invoice(self, i, fields):
+        i.update(fields)
+        fields = Invoice.fields_to_json(fields)
+        columns = list(fields)
+        self.db.execute("UPDATE invoices SET %s WHERE label = ?" %
+                        ", ".join("%s = ?" % c for c in columns),
+                        [fields[c] for c in columns] + [i.label])
+        self.dirty = True
+
+    def remove_invoice(self, label):
+        i = self.get_invoice(label)
+        self.db.execute("DELETE FROM invoices WHERE label = ?", (label,))
+        self.dirty = True
+        return i
+
+    def expire_invoices(self, now):
+        expired = self.db.execute("UPDATE invoices SET status = 'expired' "
+                                  "WHERE status = 'unpaid' AND "
+                                  "expires_at < ?", (now,)).rowcount
+        if expired:
+            self.dirty = True
+        return expired
+
+    def clean_expired(self, now, expired_by):
+        cleaned = self.db.execute("DELETE FROM invoices "
+                                  "WHERE status = 'expired' AND "
+                                  "expires_at <= ?",
+                                  (now - expired_by,)).rowcount
+        if cleaned:
+            self.dirty = True
+        return cleaned
 
 ###############################################################################
 
+class CommandStats(object):
+    """ Call counts, latency histograms and the time spent parsing
+    arguments, signing bolt11s and persisting the state, per command. """
+    # upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1.0]
+    BUCKET_LABELS = ["<=100us", "<=1ms", "<=10ms", "<=100ms", "<=1s", ">1s"]
+
+    def __init__(self, commands=None):
+        self.commands = commands or {}
+        self.local = threading.local()
+
+    @property
+    def phases(self):
+        # phase timings of the command this thread is timing, if any
+        return getattr(self.local, 'phases', None)
+
+    @phases.setter
+    def phases(self, phases):
+        self.local.phases = phases
+
+    def _command(self, command):
+        c = self.commands.get(command)
+        if c is None:
+            c = self.commands[command] = {
+                'calls':         0,
+                'total_seconds': 0.0,
+                'max_seconds':   0.0,
+                'histogram':     [0] * len(self.BUCKET_LABELS),
+                'phase_seconds': {}}
+        return c
+
+    def record_phase(self, command, phase, seconds):
+        phases = self._command(command)['phase_seconds']
+        phases[phase] = phases.get(phase, 0) + seconds
+
+    def record(self, command, seconds, phases=None):
+        c = self._command(command)
+        c['calls'] += 1
+        c['total_seconds'] += seconds
+        c['max_seconds'] = max(c['max_seconds'], seconds)
+        c['histogram'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        for phase, t in (phases or {}).items():
+            self.record_phase(command, phase, t)
+
+    def reset(self):
+        self.commands = {}
+
+    def to_json(self):
+        commands = {}
+        for name, c in self.commands.items():
+            commands[name] = {
+                'calls':             c['calls'],
+                'total_seconds':     c['total_seconds'],
+                'mean_seconds':      c['total_seconds'] / c['calls'],
+                'max_seconds':       c['max_seconds'],
+                'latency_histogram': dict(zip(self.BUCKET_LABELS,
+                                              c['histogram'])),
+                'phase_seconds':     dict(c['phase_seconds'])}
+        return {'enabled': True, 'commands': commands}
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        f = open(path, 'r')
+        commands = json.loads(f.read())
+        f.close()
+        return cls(commands)
+
+    def save(self, path):
+        f = open(path, 'w')
+        f.write(json.dumps(self.commands))
+        f.close()
+
+
+def timed_command(method):
+    """ Records each call of a MockDaemon command in its stats, when they
+    are on. Commands called from within another count towards that one. """
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None or stats.phases is not None:
+            return method(self, *args, **kwargs)
+        stats.phases = {}
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            phases, stats.phases = stats.phases, None
+            stats.record(method.__name__, time.perf_counter() - start, phases)
+    timed.timed = True
+    return timed
+
+###############################################################################
+
+class FileWaiter(object):
+    """
+    Lets a CLI invocation sleep until another process changes the state
+    file, rather than re-reading it in a loop. The waiter binds a unix
+    datagram socket in WAITERS_DIR; whoever writes a change that waiters
+    care about sends a byte to every socket there with notify_all().
+    """
+    def __init__(self):
+        import socket
+        os.makedirs(WAITERS_DIR, exist_ok=True)
+        self.path = os.path.join(WAITERS_DIR, "%d-%s" %
+                                 (os.getpid(), os.urandom(4).hex()))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+    def wait(self, timeout=None):
+        # returns early on a notification, which also uses up any others
+        # that arrived since the last wait
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.recv(16)
+        except OSError:
+            # timed out
+            return
+        self.sock.setblocking(False)
+        try:
+            while True:
+                self.sock.recv(16)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def notify_all():
+        try:
+            names = os.listdir(WAITERS_DIR)
+        except FileNotFoundError:
+            return
+        if not names:
+            return
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(WAITERS_DIR, name)
+            try:
+                sock.sendto(b"\n", path)
+            except BlockingIOError:
+                # its queue is full, so it has plenty to wake it already
+                pass
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by an invocation that was killed
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        sock.close()
+
+###############################################################################
+
+def non_negative_int(value):
+    # an argparse type
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError("%s is negative" % value)
+    return n
+
+
+def positive_int(value):
+    # an argparse type
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("%s is less than 1" % value)
+    return n
+
+
 class MockDaemon(object):
-    def __init__(self, in_memory, mock_bolt11=False):
-        self.state = DaemonState(in_memory)
+    def __init__(self, in_memory, mock_bolt11=False, backend=STATE_BACKEND,
+                 write_behind=0, lock=False, template_bolt11=False,
+                 signer=None, stats=STATS_ENABLED, lazy_bolt11=False):
+        self.backend = backend
+        self.state = self._open_state(in_memory, write_behind, lock)
         self.mock_bolt11 = mock_bolt11
+        # template_bolt11 gives real, decodable bolt11s much more cheaply
+        # than encoding each from scratch; see Bolt11Template.
+        self.template_bolt11 = template_bolt11
+        # a secp256k1.PrivateKey to sign with; None for the shared one for
+        # SIGNING_KEY
+        self.signer = signer
+        # lazy_bolt11 leaves each bolt11 unsigned until something reads it:
+        # the invoice response, listinvoices or writing the state out. With
+        # an in-memory state, invoices whose bolt11 nobody looks at are
+        # never signed at all.
+        self.lazy_bolt11 = lazy_bolt11
+        # None when not timing commands, which then costs nothing
+        self.stats = CommandStats() if stats else None
+        # Notified whenever invoices get paid, deleted or may have expired,
+        # for waitanyinvoice/waitinvoice callers on other threads. Listeners
+        # are called with (label, pay_index) at the same points; the RPC
+        # server wakes its waiting requests from one.
+        self.changed = threading.Condition()
+        self.listeners = []
+        self.notify_files = False
+
+    def _open_state(self, in_memory, write_behind=0, lock=False):
+        if self.backend == 'sqlite':
+            return SqliteDaemonState(in_memory, write_behind=write_behind,
+                                     lock=lock)
+        return DaemonState(in_memory, journal=(self.backend == 'journal'),
+                           write_behind=write_behind, lock=lock)
 
     ###########################################################################
 
     def _get_time(self):
         return int(time.time()) + self.state['time_offset']
 
+    def _phase(self, phase, fn, *args):
+        # fn(*args), timed as part of the command in progress
+        if self.stats is None or self.stats.phases is None:
+            return fn(*args)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            phases = self.stats.phases
+            phases[phase] = (phases.get(phase, 0) +
+                             time.perf_counter() - start)
+
+    def _write_state(self):
+        self._phase('persist', self.state.write_state)
+        self._notify_files()
+
     ###########################################################################
 
-    def _gen_bolt11(self, args, payment_hash):
-        addr = LnAddr()
-        addr.currency = 'bc'
-        addr.failback = None
-        addr.amount = args.msatoshi / MSATOSHIS_PER_BTC
-        addr.date = self._get_time()
-        addr.paymenthash = unhexlify(payment_hash)
-        addr.tags.append(('d', args.description))
-        addr.tags.append(('x', str(args.expiry)))
-        return (MOCK_BOLT11 if self.mock_bolt11 else
-                lnencode(addr, SIGNING_KEY))
+    def _encoder(self, signer=None):
+        signer = signer or self.signer
+        if self.template_bolt11:
+            return bolt11_template(signer).encode
+        return functools.partial(encode_bolt11, signer=signer)
+
+    def _gen_bolt11(self, args, payment_hash, date, signer=None):
+        if self.mock_bolt11:
+            return MOCK_BOLT11
+        if self.lazy_bolt11:
+            return LazyBolt11(self, args.description, args.expiry)
+        return self._encoder(signer)(args.msatoshi, args.description,
+                                     args.expiry, payment_hash, date)
 
     def _get_payment_hash(self, preimage):
         # return the sha256 digest string of the preimage bytes
         preimage_bytes = bytes.fromhex(preimage)
         return hashlib.sha256(preimage_bytes).hexdigest()
 
+    def _invoice_record(self, args, payment_hash, bolt11, now):
+        return Invoice(args.label, bolt11, bytes.fromhex(payment_hash),
+                       args.msatoshi, now + args.expiry)
+
     def _new_invoice(self, args):
+        if args.preimage is None:
+            args.preimage = os.urandom(32).hex()
         payment_hash = self._get_payment_hash(args.preimage)
-        bolt11 = self._gen_bolt11(args, payment_hash)
         now = self._get_time()
-        return {"label":        args.label,
-                "bolt11":       bolt11,
-                "payment_hash": payment_hash,
-                "msatoshi":     args.msatoshi,
-                "status":       "unpaid",
-                "expires_at":   now + args.expiry,
-                "expiry_time":  now + args.expiry}
-
-    def invoice(self, args):
-        labels = set(i['label'] for i in self.state['invoices'])
-        if args.label in labels:
+        bolt11 = self._phase('sign', self._gen_bolt11, args, payment_hash,
+                             now)
+        return self._invoice_record(args, payment_hash, bolt11, now)
+
+    def _check_label(self, label):
+        if self.state.get_invoice(label):
             sys.exit("*** label already in set?")
-        i = self._new_invoice(args)
-        self.state['invoices'].append(i)
-        self.state.write_state()
-        output = {'payment_hash': i['payment_hash'],
-                  'expiry_time':  i['expiry_time'],
-                  'expires_at':   i['expires_at'],
-                  'bolt11':       i['bolt11']}
+
+    def _invoice_output(self, i, **extra):
+        output = {'payment_hash': i.payment_hash.hex(),
+                  'expiry_time':  i.expires_at,
+                  'expires_at':   i.expires_at,
+                  'bolt11':       i.bolt11 if i.bolt11_signed else None}
+        output.update(extra)
+        if not i.bolt11_signed:
+            return InvoiceOutput(i, output)
         return output
 
+    def _commit_invoice(self, i):
+        # _new_invoice() doesn't touch the state, so it can run elsewhere
+        # (eg. on a worker thread) with the label checked again here.
+        self._check_label(i.label)
+        self.state.add_invoice(i)
+        self._write_state()
+        return self._invoice_output(i)
+
+    @timed_command
+    def invoice(self, msatoshi, label, description, expiry=3600,
+                preimage=None):
+        args = argparse.Namespace(msatoshi=msatoshi, label=label,
+                                  description=description, expiry=expiry,
+                                  preimage=preimage)
+        self._check_label(label)
+        return self._commit_invoice(self._new_invoice(args))
+
     ###########################################################################
 
-    def _iter_remaining(self, now):
-        for i in self.state['invoices']:
-            if i['status'] != 'expired':
-                yield i
-            expired_for = now - i['expiry_time']
-            if expired_for < self.state['autoclean_expired_by']:
-                yield i
+    def _batch_args(self, specs):
+        args_list = []
+        for spec in specs:
+            if not isinstance(spec, dict):
+                sys.exit("*** invoice spec isn't an object: %s" %
+                         json.dumps(spec))
+            missing = [k for k in ('msatoshi', 'label', 'description')
+                       if k not in spec]
+            if missing:
+                sys.exit("*** invoice spec missing %s: %s" %
+                         (", ".join(missing), json.dumps(spec)))
+            if not (isinstance(spec['label'], str) and
+                    isinstance(spec['description'], str)):
+                sys.exit("*** invoice spec label and description should be "
+                         "strings: %s" % json.dumps(spec))
+            try:
+                msatoshi = int(spec['msatoshi'])
+                expiry = int(spec.get('expiry', 3600))
+                preimage = spec.get('preimage')
+                if preimage is not None and len(bytes.fromhex(preimage)) != 32:
+                    raise ValueError(preimage)
+            except (TypeError, ValueError):
+                sys.exit("*** invoice spec msatoshi and expiry should be "
+                         "integers and preimage 64 hex digits: %s" %
+                         json.dumps(spec))
+            args_list.append(argparse.Namespace(
+                msatoshi=msatoshi, label=spec['label'],
+                description=spec['description'], expiry=expiry,
+                preimage=preimage))
+        return args_list
+
+    def _check_batch_labels(self, args_list):
+        seen = set()
+        taken = []
+        for args in args_list:
+            if args.label in seen or self.state.get_invoice(args.label):
+                taken.append(args.label)
+            seen.add(args.label)
+        if taken:
+            sys.exit("*** labels already in set: %s" % ", ".join(taken))
+
+    def _new_invoices(self, args_list, workers=None):
+        # Like _new_invoice(), doesn't touch the state. Signing is spread
+        # over a process pool when the batch is big enough to be worth it.
+        now = self._get_time()
+        payment_hashes = []
+        for args in args_list:
+            if args.preimage is None:
+                args.preimage = os.urandom(32).hex()
+            payment_hashes.append(self._get_payment_hash(args.preimage))
+        params = [(args.msatoshi, args.description, args.expiry,
+                   payment_hash, now)
+                  for args, payment_hash in zip(args_list, payment_hashes)]
+        bolt11s = self._phase('sign', self._gen_bolt11s, params, workers)
+        return [self._invoice_record(args, payment_hash, bolt11, now)
+                for args, payment_hash, bolt11
+                in zip(args_list, payment_hashes, bolt11s)]
+
+    def _gen_bolt11s(self, params, workers):
+        if self.mock_bolt11:
+            return [MOCK_BOLT11] * len(params)
+        if self.lazy_bolt11:
+            return [LazyBolt11(self, description, expiry)
+                    for _, description, expiry, _, _ in params]
+        if (self.template_bolt11 or self.signer or workers == 1 or
+                len(params) < BATCH_POOL_MIN):
+            # templated bolt11s stay in this process, where they're memoized,
+            # and a caller's own signer can't be sent to worker processes
+            encode = self._encoder()
+            return [encode(*p) for p in params]
+        import concurrent.futures
+        # ProcessPoolExecutor's default is one worker per CPU, too
+        workers = workers or os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            chunksize = max(1, len(params) // (workers * 4))
+            return list(pool.map(_encode_bolt11_params, params,
+                                 chunksize=chunksize))
+
+    def _commit_invoices(self, invoices):
+        self._check_batch_labels([argparse.Namespace(label=i.label)
+                                  for i in invoices])
+        outputs = []
+        for i in invoices:
+            self.state.add_invoice(i)
+            outputs.append(self._invoice_output(i, label=i.label))
+        self._write_state()
+        return {'invoices': outputs}
+
+    @timed_command
+    def invoice_batch(self, specs, workers=None):
+        """ Create invoices for a list of specs, each a dict with msatoshi,
+        label and description and optionally expiry (default 3600) and
+        preimage (default random). All labels are checked up front and the
+        state is written once for the whole batch. """
+        args_list = self._batch_args(specs)
+        self._check_batch_labels(args_list)
+        return self._commit_invoices(self._new_invoices(args_list, workers))
+
+    @timed_command
+    def invoicebatch(self, file, workers=None):
+        f = sys.stdin if file == '-' else open(file, 'r')
+        specs = []
+        try:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    specs.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    sys.exit("*** %s line %d isn't JSON: %s at column %d" %
+                             (file, n, e.msg, e.colno))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        return self.invoice_batch(specs, workers)
+
+    ###########################################################################
 
     def _autoclean(self, now):
         if self.state['autoclean_cycle_seconds'] == 0:
@@ -136,90 +1244,291 @@ class MockDaemon(object):
         if elapsed < self.state['autoclean_cycle_seconds']:
             return
 
-        for i in self.state['invoices']:
-            if i['status'] != 'expired':
-                continue
-        self.state['invoices'] = list(self._iter_remaining(now))
+        cleaned = self.state.clean_expired(now,
+                                           self.state['autoclean_expired_by'])
+        self.state['autoclean_cycle_cleaned'] = cleaned
+        self.state['autoclean_total_cleaned'] += cleaned
         self.state['autoclean_last_clean'] = now
 
-
-    def listinvoices(self, args):
+    @timed_command
+    def listinvoices(self, label=None, status=None, limit=None, offset=0,
+                     after_pay_index=None, stream=False):
+        """ Lists invoices, optionally only those with the given status or
+        paid after the given pay index (in the order they were paid), a page
+        of limit of them after skipping offset. With stream=True the
+        invoices are returned as an iterator rather than a list in
+        {'invoices': [...]}, to be written out one at a time. """
+        if status is not None:
+            if status not in Invoice.STATUS_CODES:
+                return {"code": -1, "message": "Invalid status"}
+            status = Invoice.STATUS_CODES[status]
+        if limit is not None and (not isinstance(limit, int) or limit < 0):
+            return {"code": -1, "message": "Invalid limit"}
+        if not isinstance(offset, int) or offset < 0:
+            return {"code": -1, "message": "Invalid offset"}
+        if after_pay_index is not None and (
+                not isinstance(after_pay_index, int) or after_pay_index < 0):
+            return {"code": -1, "message": "Invalid after_pay_index"}
         timestamp = self._get_time()
-        for i in self.state['invoices']:
-            if i['status'] != 'unpaid':
-                continue
-            if timestamp > i['expires_at']:
-                i['status'] = "expired"
+        self.state.expire_invoices(timestamp)
         self._autoclean(timestamp)
-        self.state.write_state()
-        return {'invoices': self.state['invoices']}
+        self._write_state()
+        if label is not None:
+            i = self.state.get_invoice(label)
+            if (i and (status is None or i.status == status) and
+                    (after_pay_index is None or
+                     (i.pay_index is not None and
+                      i.pay_index > after_pay_index)) and
+                    offset == 0 and limit != 0):
+                invoices = iter([i])
+            else:
+                invoices = iter([])
+        else:
+            invoices = self.state.iter_invoices(status, after_pay_index,
+                                                offset, limit)
+        if stream:
+            return map(Invoice.to_json, invoices)
+        return {'invoices': [i.to_json() for i in invoices]}
 
     ###########################################################################
 
-    def autocleaninvoice(self, args):
+    @timed_command
+    def autocleaninvoice(self, cycle_seconds=3600, expired_by=86400):
         timestamp = self._get_time()
-        self.state['autoclean_cycle_seconds'] = args.cycle_seconds
+        self.state['autoclean_cycle_seconds'] = cycle_seconds
         self.state['autoclean_last_clean'] = timestamp
-        self.state['autoclean_expired_by'] = args.expired_by
-        self.state.write_state()
+        self.state['autoclean_expired_by'] = expired_by
+        self._write_state()
 
     ###########################################################################
 
-    def delinvoice(self, args):
-        invoice = None
-        for i in self.state['invoices']:
-            if i['label'] == args.label:
-                invoice = i
-                break
+    @timed_command
+    def delinvoice(self, label, status):
+        invoice = self.state.get_invoice(label)
         if not invoice:
             return {"code": -1, "message": "Unknown invoice"}
-        if invoice['status'] != args.status:
+        if Invoice.STATUSES[invoice.status] != status:
             return {"code": -1, "message": "Wrong status"}
-        self.state['invoices'] = [i for i in self.state['invoices'] if
-                                  i['label'] != args.label]
-        self.state.write_state()
-        return invoice
+        self.state.remove_invoice(label)
+        self._notify(label)
+        self._write_state()
+        return invoice.to_json()
 
     ###########################################################################
 
-    def _get_next_pay_index(self):
-        i_list = [i['pay_index'] for i in self.state['invoices']
-                  if i['status'] == 'paid']
-        current_max = max(i_list) if len(i_list) > 0 else 0
-        return current_max + 1
-
     def _set_paid(self, i):
-        pay_index = self._get_next_pay_index()
-        i['status'] = "paid"
-        i['paid_at'] = self._get_time()
-        i['paid_timestamp'] = self._get_time()
-        # add some fees arbitrarily, so it looks more like a real node
-        i['msatoshi_recieved'] = i['msatoshi'] + 33
-        i['pay_index'] = pay_index
-
-    def markpaid(self, args):
-        for i in self.state['invoices']:
-            if i['label'] == args.label:
-                self._set_paid(i)
-                self.state.write_state()
-                return None
-        return {"code": -1, "message": "unknown invoice"}
+        fields = {'status':            Invoice.PAID,
+                  'paid_at':           self._get_time(),
+                  # add some fees arbitrarily, so it looks more like a real
+                  # node
+                  'msatoshi_received': i.msatoshi + 33}
+        # last, so that nothing above can fail with the index used up
+        fields['pay_index'] = self.state.allocate_pay_index()
+        self.state.update_invoice(i, fields)
+
+    @timed_command
+    def markpaid(self, label):
+        i = self.state.get_invoice(label)
+        if not i:
+            return {"code": -1, "message": "unknown invoice"}
+        self._set_paid(i)
+        self._notify(label, i.pay_index)
+        self._write_state()
+        return None
 
     ###########################################################################
 
-    def advancetime(self, args):
-        self.state['time_offset'] = self.state['time_offset'] + args.seconds
-        self.state.write_state()
+    def _notify(self, label=None, pay_index=None):
+        # Invoice {label} was paid or deleted, or with no label, any unpaid
+        # invoice may have expired (time moved, or the state was reset).
+        with self.changed:
+            self.changed.notify_all()
+        for listener in self.listeners:
+            listener(label, pay_index)
+        if not self.state.in_memory:
+            self.notify_files = True
+
+    def _notify_files(self):
+        # CLI waiters read the state file, so they're only told once the
+        # change has been written out
+        if self.notify_files and not self.state.dirty:
+            self.notify_files = False
+            FileWaiter.notify_all()
+
+    def _seconds_until_expired(self, i):
+        # the invoice counts as expired once the mock time passes expires_at
+        return i.expires_at + 1 - (time.time() + self.state['time_offset'])
+
+    def _check_paid_after(self, lastpay_index):
+        # (response, seconds to wait at most) as _wait() takes them
+        i = next(self.state.iter_invoices(Invoice.PAID, lastpay_index, 0, 1),
+                 None)
+        return (i.to_json() if i else None), None
+
+    def _check_settled(self, label):
+        i = self.state.get_invoice(label)
+        if not i:
+            return {"code": -1, "message": "Unknown invoice"}, None
+        if i.status == Invoice.PAID:
+            return i.to_json(), None
+        seconds = self._seconds_until_expired(i)
+        if i.status == Invoice.EXPIRED or seconds <= 0:
+            return {"code": -2, "message": "invoice expired during wait"}, None
+        return None, seconds
+
+    def _wait_step(self, check, deadline):
+        # check() once; either the response, or None and how long to wait
+        # before checking again if nothing changes in the meantime
+        response, seconds = check()
+        if response is None and deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return {"code": 904, "message": "Timed out"}, None
+            seconds = left if seconds is None else min(seconds, left)
+        return response, seconds
+
+    def _wait(self, check, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.state.lock_file is not None:
+            return self._wait_file(check, deadline)
+        with self.changed:
+            while True:
+                response, seconds = self._wait_step(check, deadline)
+                if response is not None:
+                    return response
+                self.changed.wait(seconds)
+
+    def _wait_file(self, check, deadline):
+        # A CLI invocation holds the state lock, which other invocations
+        # need in order to change anything; let it go while asleep and read
+        # the state afresh when woken. The socket is bound before the lock
+        # is released, so no change made after the first check goes unseen.
+        waiter = FileWaiter()
+        try:
+            while True:
+                response, seconds = self._wait_step(check, deadline)
+                if response is not None:
+                    return response
+                self.state.close()
+                waiter.wait(seconds)
+                self.state = self._open_state(False, lock=True)
+        finally:
+            waiter.close()
+
+    # Not timed: how long these take is up to whoever pays the invoices.
+
+    def waitanyinvoice(self, lastpay_index=0, timeout=None):
+        """ Blocks until an invoice is paid after the one with
+        lastpay_index, returning the first such invoice (which may have been
+        paid already). With timeout, gives up after that many seconds. """
+        return self._wait(functools.partial(self._check_paid_after,
+                                            lastpay_index), timeout)
+
+    def waitinvoice(self, label):
+        """ Blocks until invoice {label} is paid, returning it, or expires
+        or is deleted, returning an error. """
+        return self._wait(functools.partial(self._check_settled, label))
+
+    ###########################################################################
+
+    @timed_command
+    def advancetime(self, seconds):
+        self.state['time_offset'] = self.state['time_offset'] + seconds
+        self._notify()
+        self._write_state()
 
     ###########################################################################
 
-    def reset(self, args):
+    @timed_command
+    def reset(self):
         self.state.reset()
-        self.state.write_state()
+        self._notify()
+        self._write_state()
+
+    ###########################################################################
+
+    @timed_command
+    def exportstate(self, file):
+        self.state.export(file)
+
+    ###########################################################################
+
+    def get_stats(self):
+        if self.stats is None:
+            return {'enabled': False, 'commands': {}}
+        return self.stats.to_json()
+
+    def reset_stats(self):
+        if self.stats is not None:
+            self.stats.reset()
+
+    def getstats(self, reset=False):
+        stats = self.get_stats()
+        # from the state, so reported with stats off too and never reset
+        stats['autoclean'] = {
+            'cycle_cleaned': self.state['autoclean_cycle_cleaned'],
+            'total_cleaned': self.state['autoclean_total_cleaned']}
+        if reset:
+            self.reset_stats()
+        return stats
+
+    ###########################################################################
+
+    def flush(self):
+        self.state.flush()
+        self._notify_files()
+
+    def close(self):
+        self.state.close()
+        self._notify_files()
+
+    def serve(self, rpc_file, in_memory=False, write_behind=0,
+              template_bolt11=False):
+        import rpc_server
+        # The server owns its in-memory copy of the state from here on, so
+        # don't hold CLI invocations off for its whole lifetime.
+        self.state.unlock()
+        if in_memory:
+            self.state = DaemonState(True)
+        self.state.write_behind = write_behind
+        self.template_bolt11 = template_bolt11
+        if self.stats is not None:
+            # The server keeps its own stats, for 'getstats' over RPC; the
+            # CLI's stay in STATS_FILE.
+            self.stats = CommandStats()
+        rpc_server.serve(rpc_file, self)
 
     ###########################################################################
 
     def run_cmd(self, argv):
+        parser = self._parser()
+        if self.stats is None:
+            return self._dispatch(parser, parser.parse_args(argv))
+        start = time.perf_counter()
+        args = parser.parse_args(argv)
+        parsed = time.perf_counter() - start
+        try:
+            return self._dispatch(parser, args)
+        finally:
+            # only for commands that are timed (see timed_command)
+            name = args.subparser_name
+            if name and getattr(getattr(self, name), 'timed', False):
+                self.stats.record_phase(name, 'parse', parsed)
+
+    def _dispatch(self, parser, args):
+        # each subcommand is the method of the same name, which takes the
+        # parsed arguments as keywords
+        kwargs = dict(vars(args))
+        name = kwargs.pop('subparser_name')
+        if not name:
+            parser.print_help()
+            return None
+        return getattr(self, name)(**kwargs)
+
+    @staticmethod
+    @functools.lru_cache(None)
+    def _parser():
+        # built once and shared, since it doesn't depend on the daemon
         parser = argparse.ArgumentParser(description='mock c-lightning')
         subparsers = parser.add_subparsers(dest='subparser_name',
                                            help='sub-command help')
@@ -234,13 +1543,39 @@ class MockDaemon(object):
                                 help='seconds until invoice expiry')
         parser_inv.add_argument('preimage',
                                 help='preimage value')
-        parser_inv.set_defaults(cmd=self.invoice)
+
+        # invoicebatch (not c-lightning cmd):
+        parser_batch = subparsers.add_parser('invoicebatch',
+                                             help=('create invoices from a '
+                                                   'JSON-lines file of specs'))
+        parser_batch.add_argument('file',
+                                  help=('file with one JSON object per line '
+                                        'with msatoshi, label, description '
+                                        'and optional expiry and preimage, '
+                                        'or - for stdin'))
+        parser_batch.add_argument('--workers', type=positive_int,
+                                  default=None,
+                                  help=('processes signing bolt11s (default '
+                                        'one per CPU)'))
 
         # listinvoices:
         parser_list = subparsers.add_parser('listinvoices',
                                             help='listinvoices help')
         parser_list.add_argument('--label', help='label string of invoice')
-        parser_list.set_defaults(cmd=self.listinvoices)
+        parser_list.add_argument('--status',
+                                 choices=['paid', 'unpaid', 'expired'],
+                                 help='only invoices with this status')
+        parser_list.add_argument('--limit', type=non_negative_int,
+                                 help='list at most {limit} invoices')
+        parser_list.add_argument('--offset', type=non_negative_int, default=0,
+                                 help='skip the first {offset} invoices')
+        parser_list.add_argument('--after-pay-index', type=non_negative_int,
+                                 help=('only invoices paid after the one with '
+                                       'this pay_index, in the order they '
+                                       'were paid'))
+        parser_list.add_argument('--stream', action='store_true',
+                                 help=('write one JSON invoice per line as '
+                                       'they are read'))
 
         # autocleaninvoice:
         parser_clean = subparsers.add_parser('autocleaninvoice',
@@ -253,7 +1588,6 @@ class MockDaemon(object):
                                   help=('Clean up expired invoices that have '
                                         'expired for {expired_by} seconds '
                                         '(default 86400).'))
-        parser_clean.set_defaults(cmd=self.autocleaninvoice)
 
         # delinvoice:
         parser_list = subparsers.add_parser('delinvoice',
@@ -264,36 +1598,93 @@ class MockDaemon(object):
         parser_list.add_argument('status', type=str,
                                  choices=['paid', 'unpaid', 'expired'],
                                  help='status of invoice')
-        parser_list.set_defaults(cmd=self.delinvoice)
 
         # markpaid (not c-lightning cmd):
         parser_paid = subparsers.add_parser('markpaid', help='markpaid help')
         parser_paid.add_argument('label', help='label string of invoice')
-        parser_paid.set_defaults(cmd=self.markpaid)
+
+        # waitanyinvoice:
+        parser_waitany = subparsers.add_parser('waitanyinvoice',
+                                               help=('wait for an invoice to '
+                                                     'be paid'))
+        parser_waitany.add_argument('lastpay_index', type=int, nargs='?',
+                                    default=0,
+                                    help=('return the first invoice paid '
+                                          'after the one with this pay_index '
+                                          '(default 0)'))
+        parser_waitany.add_argument('--timeout', type=float,
+                                    help=('give up after {timeout} seconds'))
+
+        # waitinvoice:
+        parser_wait = subparsers.add_parser('waitinvoice',
+                                            help=('wait for invoice {label} '
+                                                  'to be paid or expire'))
+        parser_wait.add_argument('label', help='label string of invoice')
 
         # advancetime (not c-lightning cmd):
         parser_advancetime = subparsers.add_parser('advancetime',
                                                    help='advancetime help')
         parser_advancetime.add_argument('seconds', type=int,
                                         help='seconds to advance time offset')
-        parser_advancetime.set_defaults(cmd=self.advancetime)
 
         # reset (not c-lightning cmd):
         parser_reset = subparsers.add_parser('reset', help='reset help')
-        parser_reset.set_defaults(cmd=self.reset)
 
-        args = parser.parse_args(argv)
-        if not args.subparser_name:
-            parser.print_help()
-            return None
-        return args.cmd(args)
+        # exportstate (not c-lightning cmd):
+        parser_export = subparsers.add_parser('exportstate',
+                                              help=('write the whole state '
+                                                    'as pretty JSON'))
+        parser_export.add_argument('file', help='path to write the JSON to')
+
+        # getstats (not c-lightning cmd):
+        parser_stats = subparsers.add_parser('getstats',
+                                             help=('per-command call counts '
+                                                   'and timings, with '
+                                                   'MOCK_C_LIGHTNING_STATS=1, '
+                                                   'and autoclean counts'))
+        parser_stats.add_argument('--reset', action='store_true',
+                                  help='clear the stats after reporting them')
+
+        # serve (not c-lightning cmd):
+        parser_serve = subparsers.add_parser('serve',
+                                             help=('serve JSON-RPC on a unix '
+                                                   'socket until interrupted'))
+        parser_serve.add_argument('--rpc-file', required=True,
+                                  help='path of the unix socket to create')
+        parser_serve.add_argument('--in-memory', action='store_true',
+                                  help=('start from an empty state and never '
+                                        'write the state file'))
+        parser_serve.add_argument('--write-behind', type=float, default=0,
+                                  help=('write the state at most once every '
+                                        '{write_behind} seconds (default 0, '
+                                        'after every change)'))
+        parser_serve.add_argument('--template-bolt11', action='store_true',
+                                  help=('encode bolt11s from cached parts and '
+                                        'memoize them (see Bolt11Template)'))
+
+        return parser
 
 
 ###############################################################################
 
 if __name__ == "__main__":
-    daemon = MockDaemon(False)
+    daemon = MockDaemon(False, lock=True)
+    if daemon.state.lock_wait > LOCK_WAIT_REPORT_SECONDS:
+        sys.stderr.write("waited %.3fs for the state lock\n" %
+                         daemon.state.lock_wait)
+    cli_stats = None
+    if daemon.stats is not None:
+        # each invocation adds its own timings, under the state lock
+        cli_stats = daemon.stats = CommandStats.load(STATS_FILE)
     output = daemon.run_cmd(sys.argv[1:])
+    if isinstance(output, collections.abc.Iterator):
+        # streamed (listinvoices --stream), before the state is closed
+        for item in output:
+            sys.stdout.write(json.dumps(item, sort_keys=True) + "\n")
+        output = None
+    if cli_stats is not None and daemon.stats is cli_stats:
+        cli_stats.save(STATS_FILE)
+    daemon.close()
     if output:
         print(json.dumps(output, indent=2, sort_keys=True))
     if isinstance(output, list) and (len(output) == 0):
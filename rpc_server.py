@@ -0,0 +1,447 @@
+"""
+JSON-RPC front end for MockDaemon on a unix domain socket.
+
+This speaks the same protocol as c-lightning's lightning-rpc socket so that
+pylightning's LightningRpc (and hence RealDaemon) can be pointed at a mock
+that stays resident in memory instead of shelling out per call.
+
+The server runs on an asyncio event loop. All MockDaemon state is touched
+only from the loop thread; the one slow step, signing new invoices'
+bolt11s, is handed to a thread pool so it doesn't hold up other clients.
+waitanyinvoice and waitinvoice requests wait on futures that the daemon's
+change notifications resolve, so they neither block the loop nor poll.
+"""
+
+import os
+import json
+import time
+import heapq
+import signal
+import asyncio
+import collections
+import functools
+import itertools
+import argparse
+import concurrent.futures
+
+# Parameter types: each takes a value as decoded from JSON and returns it,
+# or raises ValueError saying what it should have been. Unlike the CLI's
+# argparse types these don't convert, so 0.5 is never truncated to 0.
+
+def integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("an integer")
+    return value
+
+
+def non_negative_integer(value):
+    if integer(value) < 0:
+        raise ValueError("a non-negative integer")
+    return value
+
+
+def worker_count(value):
+    # more processes than CPUs only slows signing down
+    cpus = os.cpu_count() or 1
+    if integer(value) < 1 or value > cpus:
+        raise ValueError("an integer from 1 to %d" % cpus)
+    return value
+
+
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("a number")
+    return value
+
+
+def string(value):
+    if not isinstance(value, str):
+        raise ValueError("a string")
+    return value
+
+
+def preimage(value):
+    if not isinstance(value, str) or len(value) != 64:
+        raise ValueError("64 hex digits")
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        raise ValueError("64 hex digits")
+    return value
+
+
+def array(value):
+    if not isinstance(value, list):
+        raise ValueError("an array")
+    return value
+
+
+def boolean(value):
+    if not isinstance(value, bool):
+        raise ValueError("a boolean")
+    return value
+
+# Marks a parameter the caller must supply.
+REQUIRED = object()
+
+# Parameters of each command, in the order c-lightning takes them
+# positionally, with their type and the default used when an optional one
+# is left out.
+RPC_PARAMS = {
+    'invoice':          [('msatoshi', integer, REQUIRED),
+                         ('label', string, REQUIRED),
+                         ('description', string, REQUIRED),
+                         ('expiry', integer, 3600),
+                         ('preimage', preimage, None)],
+    'invoicebatch':     [('invoices', array, REQUIRED),
+                         ('workers', worker_count, None)],
+    'listinvoices':     [('label', string, None),
+                         ('status', string, None),
+                         ('limit', non_negative_integer, None),
+                         ('offset', non_negative_integer, 0),
+                         ('after_pay_index', non_negative_integer, None)],
+    'autocleaninvoice': [('cycle_seconds', integer, 3600),
+                         ('expired_by', integer, 86400)],
+    'delinvoice':       [('label', string, REQUIRED),
+                         ('status', string, REQUIRED)],
+    'markpaid':         [('label', string, REQUIRED)],
+    'waitanyinvoice':   [('lastpay_index', integer, 0),
+                         ('timeout', number, None)],
+    'waitinvoice':      [('label', string, REQUIRED)],
+    'advancetime':      [('seconds', integer, REQUIRED)],
+    'reset':            [],
+    'getstats':         [('reset', boolean, False)],
+}
+
+###############################################################################
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+    def to_json(self):
+        return {'code': self.code, 'message': self.message}
+
+
+def build_args(method, params):
+    """ Turns JSON-RPC params, either a list of positional values or an
+    object of named values, into the keyword arguments the MockDaemon
+    command methods take. Values of the wrong type are rejected here,
+    before they can reach the state. """
+    if method not in RPC_PARAMS:
+        raise RpcError(-32601, "Unknown command '%s'" % method)
+    spec = RPC_PARAMS[method]
+    if params is None:
+        params = {}
+    if isinstance(params, list):
+        if len(params) > len(spec):
+            raise RpcError(-32602, "too many parameters")
+        params = dict(zip([name for name, _, _ in spec], params))
+    if not isinstance(params, dict):
+        raise RpcError(-32602, "params must be an array or object")
+
+    unknown = set(params) - set(name for name, _, _ in spec)
+    if unknown:
+        raise RpcError(-32602, "unknown parameter: %s" %
+                       ", ".join(sorted(unknown)))
+    kwargs = {}
+    for name, check, default in spec:
+        value = params.get(name)
+        if value is None:
+            if default is REQUIRED:
+                raise RpcError(-32602, "missing required parameter: %s" %
+                               name)
+            value = default
+        else:
+            try:
+                value = check(value)
+            except ValueError as e:
+                raise RpcError(-32602, "%s should be %s, not %s" %
+                               (name, e, json.dumps(value)))
+        kwargs[name] = value
+    return kwargs
+
+###############################################################################
+
+class RpcDispatcher(object):
+    """ Runs decoded requests against a MockDaemon and builds responses. """
+    def __init__(self, daemon, executor=None):
+        self.daemon = daemon
+        self.executor = executor
+        # futures of waiting waitanyinvoice requests in a heap keyed by the
+        # pay_index they wait to see passed, and of waitinvoice requests by
+        # label
+        self.pay_waiters = []
+        self.label_waiters = {}
+        self.waiter_ids = itertools.count()
+        daemon.listeners.append(self._wake)
+
+    def _wake(self, label, pay_index):
+        # Called by the daemon, on the loop thread, when invoice {label} was
+        # paid with pay_index or deleted, or when any may have expired.
+        woken = []
+        if pay_index is not None:
+            while self.pay_waiters and self.pay_waiters[0][0] < pay_index:
+                woken.append(heapq.heappop(self.pay_waiters)[2])
+        if label is None:
+            for futures in self.label_waiters.values():
+                woken.extend(futures)
+            self.label_waiters.clear()
+        else:
+            woken.extend(self.label_waiters.pop(label, []))
+        for future in woken:
+            if not future.done():
+                future.set_result(None)
+
+    async def _wait(self, check, register, unregister, timeout=None):
+        # as MockDaemon._wait(), with register(future) to be woken and
+        # unregister(future) when it no longer needs to be
+        deadline = None if timeout is None else time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            response, seconds = self.daemon._wait_step(check, deadline)
+            if response is not None:
+                return response
+            future = loop.create_future()
+            register(future)
+            try:
+                await asyncio.wait([future], timeout=seconds)
+            finally:
+                if not future.done():
+                    # timed out, or the request was cancelled
+                    unregister(future)
+                    future.cancel()
+
+    async def _waitanyinvoice(self, kwargs):
+        lastpay_index = kwargs['lastpay_index']
+        def register(future):
+            heapq.heappush(self.pay_waiters,
+                           (lastpay_index, next(self.waiter_ids), future))
+        def unregister(future):
+            self.pay_waiters = [w for w in self.pay_waiters
+                                if w[2] is not future]
+            heapq.heapify(self.pay_waiters)
+        return await self._wait(
+            functools.partial(self.daemon._check_paid_after, lastpay_index),
+            register, unregister, kwargs['timeout'])
+
+    async def _waitinvoice(self, kwargs):
+        label = kwargs['label']
+        def register(future):
+            self.label_waiters.setdefault(label, []).append(future)
+        def unregister(future):
+            futures = self.label_waiters.get(label, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                self.label_waiters.pop(label, None)
+        return await self._wait(
+            functools.partial(self.daemon._check_settled, label), register,
+            unregister)
+
+    async def _invoice(self, kwargs):
+        args = argparse.Namespace(**kwargs)
+        # fail fast on a duplicate before paying for the signature
+        self.daemon._check_label(args.label)
+        loop = asyncio.get_running_loop()
+        i = await loop.run_in_executor(self.executor,
+                                       self.daemon._new_invoice, args)
+        return self.daemon._commit_invoice(i)
+
+    async def _invoicebatch(self, kwargs):
+        args_list = self.daemon._batch_args(kwargs['invoices'])
+        self.daemon._check_batch_labels(args_list)
+        loop = asyncio.get_running_loop()
+        invoices = await loop.run_in_executor(self.executor,
+                                              self.daemon._new_invoices,
+                                              args_list, kwargs['workers'])
+        return self.daemon._commit_invoices(invoices)
+
+    async def _call(self, method, params):
+        kwargs = build_args(method, params)
+        if self.daemon.stats is None or method not in ('invoice',
+                                                       'invoicebatch'):
+            # the other commands record their own stats
+            return await self._run(method, kwargs)
+        start = time.perf_counter()
+        try:
+            return await self._run(method, kwargs)
+        finally:
+            # no per-phase times here, since other requests run in between
+            self.daemon.stats.record(method, time.perf_counter() - start)
+
+    async def _run(self, method, kwargs):
+        try:
+            if method == 'invoice':
+                result = await self._invoice(kwargs)
+            elif method == 'invoicebatch':
+                result = await self._invoicebatch(kwargs)
+            elif method == 'waitanyinvoice':
+                result = await self._waitanyinvoice(kwargs)
+            elif method == 'waitinvoice':
+                result = await self._waitinvoice(kwargs)
+            else:
+                result = getattr(self.daemon, method)(**kwargs)
+        except SystemExit as e:
+            raise RpcError(-1, str(e.code))
+        if (isinstance(result, dict) and 'code' in result and
+                'message' in result):
+            raise RpcError(result['code'], result['message'])
+        return result
+
+    async def handle(self, request):
+        request_id = request.get('id') if isinstance(request, dict) else None
+        response = {'jsonrpc': '2.0', 'id': request_id}
+        try:
+            if isinstance(request, RpcError):
+                # RequestDecoder couldn't parse it
+                raise request
+            if not isinstance(request, dict) or 'method' not in request:
+                raise RpcError(-32600, "Invalid request")
+            response['result'] = await self._call(request['method'],
+                                                  request.get('params'))
+        except RpcError as e:
+            response['error'] = e.to_json()
+        except Exception as e:
+            # eg. a parameter of the wrong type or out of range; the client
+            # still gets an answer and the connection stays up
+            response['error'] = RpcError(-32603, "%s: %s" %
+                                         (type(e).__name__, e)).to_json()
+        return response
+
+###############################################################################
+
+class RequestDecoder(object):
+    """ Splits a byte stream into JSON requests. Requests may be back to
+    back with no delimiter (as pylightning sends them), or separated by
+    whitespace and newlines (as lightning-cli does). Text that can't be
+    parsed even though a newline follows it is given back as an RpcError
+    in place of the request, and skipped up to that newline. """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pending = b''
+
+    def feed(self, data):
+        self.pending += data
+        try:
+            self.buf += self.pending.decode('utf8')
+            self.pending = b''
+        except UnicodeDecodeError:
+            # a multi-byte character is split across reads; wait for the rest
+            return []
+        requests = []
+        while True:
+            self.buf = self.buf.lstrip()
+            if not self.buf:
+                break
+            try:
+                request, end = self.decoder.raw_decode(self.buf)
+            except ValueError as e:
+                newline = self.buf.find("\n", e.pos)
+                if newline < 0:
+                    # probably an incomplete request
+                    break
+                requests.append(RpcError(-32700, "Parse error"))
+                self.buf = self.buf[newline + 1:]
+                continue
+            requests.append(request)
+            self.buf = self.buf[end:]
+        return requests
+
+
+def encode_response(response):
+    # c-lightning terminates each response with a blank line, which newer
+    # pylightning versions split on; older ones just parse the object.
+    # default=dict serializes a daemon's lazy_bolt11 InvoiceOutputs.
+    return (json.dumps(response, default=dict) + "\n\n").encode('utf8')
+
+###############################################################################
+
+class RpcServer(object):
+    def __init__(self, rpc_file, daemon, workers=None):
+        self.rpc_file = rpc_file
+        self.daemon = daemon
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.dispatcher = RpcDispatcher(daemon, self.executor)
+
+    async def _handle_connection(self, reader, writer):
+        # Requests pipelined on one connection are answered in order. The
+        # connection is still read while a request is handled, so that a
+        # client hanging up (say during a waitanyinvoice with no timeout)
+        # cancels it instead of leaving its waiter registered for good.
+        decoder = RequestDecoder()
+        requests = collections.deque()
+        reading = handling = None
+        try:
+            while True:
+                if reading is None:
+                    reading = asyncio.ensure_future(reader.read(65536))
+                if handling is None and requests:
+                    handling = asyncio.ensure_future(
+                        self.dispatcher.handle(requests.popleft()))
+                done, _ = await asyncio.wait(
+                    [t for t in (handling, reading) if t],
+                    return_when=asyncio.FIRST_COMPLETED)
+                if handling in done:
+                    writer.write(encode_response(handling.result()))
+                    handling = None
+                    if not requests:
+                        await writer.drain()
+                if reading in done:
+                    data = reading.result()
+                    reading = None
+                    if not data:
+                        break
+                    requests.extend(decoder.feed(data))
+        except ConnectionError:
+            pass
+        finally:
+            for task in (reading, handling):
+                if task:
+                    task.cancel()
+            writer.close()
+
+    async def _flush_periodically(self, interval):
+        # With write-behind, write_state() leaves changes unwritten while a
+        # write was recent; make sure they reach disk once things go quiet.
+        while True:
+            await asyncio.sleep(interval)
+            self.daemon.flush()
+
+    async def run(self):
+        if os.path.exists(self.rpc_file):
+            os.unlink(self.rpc_file)
+        server = await asyncio.start_unix_server(self._handle_connection,
+                                                 path=self.rpc_file)
+        if self.daemon.state.write_behind:
+            asyncio.ensure_future(
+                self._flush_periodically(self.daemon.state.write_behind))
+        # stop serving on SIGTERM as on ^C, so that close() still runs
+        loop = asyncio.get_running_loop()
+        serving = asyncio.ensure_future(server.serve_forever())
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, serving.cancel)
+        async with server:
+            try:
+                await serving
+            except asyncio.CancelledError:
+                pass
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.daemon.flush()
+        if os.path.exists(self.rpc_file):
+            os.unlink(self.rpc_file)
+
+
+def serve(rpc_file, daemon):
+    server = RpcServer(rpc_file, daemon)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,334 @@
+#! /usr/bin/env python3
+"""
+Tests for lightning_payencode against fixed vectors: the examples from
+BOLT #11, and bolt11s made by the original bitstring-based lnencode.
+Run with either of:
+
+    python3 -m pytest -q test_lightning_payencode.py
+    python3 -m unittest test_lightning_payencode
+"""
+
+import random
+import hashlib
+import unittest
+from decimal import Decimal
+
+import secp256k1
+
+from lightning_payencode import bech32
+from lightning_payencode.lnaddr import lnencode, lndecode, LnAddr
+
+# The BOLT #11 examples are all signed with this key, whose node id is
+# SPEC_NODE, and pay to SPEC_PAYMENT_HASH.
+SPEC_PRIVKEY = \
+    "e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734"
+SPEC_NODE = bytes.fromhex(
+    "03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad")
+SPEC_PAYMENT_HASH = bytes.fromhex(
+    "0001020304050607080900010203040506070809000102030405060708090102")
+SPEC_DATE = 1496314658
+
+CAKE = ("One piece of chocolate cake, one icecream cone, one pickle, one "
+        "slice of swiss cheese, one slice of salami, one lollypop, one piece "
+        "of cherry pie, one sausage, one cupcake, and one slice of "
+        "watermelon")
+
+ROUTE = [(bytes.fromhex("029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c"
+                        "37e148f78c77255"),
+          bytes.fromhex("0102030405060708"), 1, 20, 3),
+         (bytes.fromhex("039e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c"
+                        "37e148f78c77255"),
+          bytes.fromhex("030405060708090a"), 2, 30, 4)]
+
+# (currency, amount in BTC, date, tags, bolt11), each paying to
+# SPEC_PAYMENT_HASH
+SPEC_VECTORS = [
+    ('bc', None, SPEC_DATE,
+     [('d', "Please consider supporting this project")],
+     "lnbc1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqyp"
+     "qdpl2pkx2ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxa"
+     "q8rkx3yf5tcsyz3d73gafnh3cax9rn449d9p5uxz9ezhhypd0elx87sjle52x86fux"
+     "2ypatgddc6k63n7erqz25le42c4u4ecky03ylcqca784w"),
+    ('bc', '0.0025', SPEC_DATE,
+     [('d', "1 cup coffee"), ('x', 60)],
+     "lnbc2500u1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwz"
+     "qfqypqdq5xysxxatsyp3k7enxv4jsxqzpuaztrnwngzn3kdzw5hydlzf03qdgm2hdq"
+     "27cqv3agm2awhz5se903vruatfhq77w3ls4evs3ch9zw97j25emudupq63nyw24cg2"
+     "7h2rspfj9srp"),
+    ('bc', '0.02', SPEC_DATE,
+     [('h', CAKE)],
+     "lnbc20m1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqf"
+     "qypqhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2ahrqscc6gd6q"
+     "l3jrc5yzme8v4ntcewwz5cnw92tz0pc8qcuufvq7khhr8wpald05e92xw006sq94mg"
+     "8v2ndf4sefvf9sygkshp5zfem29trqq2yxxz7"),
+    ('bc', '0.02', SPEC_DATE,
+     [('h', CAKE), ('f', "1RustyRX2oai4EYYDpQGWvEL62BBGqN9T"),
+      ('r', ROUTE)],
+     "lnbc20m1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqf"
+     "qypqhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2ahrqsfpp3qjm"
+     "p7lwpagxun9pygexvgpjdc4jdj85fr9yq20q82gphp2nflc7jtzrcazrra7wwgzxqc"
+     "8u7754cdlpfrmccae92qgzqvzq2ps8pqqqqqqpqqqqq9qqqvpeuqafqxu92d8lr6fv"
+     "g0r5gv0heeeqgcrqlnm6jhphu9y00rrhy4grqszsvpcgpy9qqqqqqgqqqqq7qqzqj9"
+     "n4evl6mr5aj9f58zp6fyjzup6ywn3x6sk8akg5v4tgn2q8g4fhx05wf6juaxu9760y"
+     "p46454gpg5mtzgerlzezqcqvjnhjh8z3g2qqdhhwkj"),
+]
+
+# The spec's testnet example puts 'h' ahead of 'p', which lnencode never
+# does, so it is only decoded.
+SPEC_TESTNET = (
+    'tb', '0.02', SPEC_DATE,
+    [('h', CAKE), ('f', "mk2QpYatsKicvFVuTAQLBryyccRXMUaGHP")],
+    "lntb20m1pvjluezhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2a"
+     "hrqspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqfpp3x9e"
+     "t2e20v6pu37c5d9vax37wxq72un98kmzzhznpurw9sgl2v0nklu2g4d0keph5t7tj9"
+     "tcqd8rexnd07ux4uv2cjvcqwaxgj7v4uwn5wmypjd5n69z2xm3xgksg28nwht7f6zs"
+     "pwp3f9t")
+
+# (currency, amount in BTC, date, tags, bolt11) as the original lnencode
+# gave them with SPEC_PRIVKEY, paying to payment_hash(n) for the n'th
+BITSTRING_VECTORS = [
+    ('bc', None, 1496314658,
+     [('d', "no amount")],
+     "lnbc1pvjluezpp5tlkwkehlephn3k2j0pkx66tv08pdhs3em48frdr898tn5flm2l5"
+     "sdq0dehjqctdda6kuaqrx3h43jup9acmgu7r0g03laj8urepvc865jgwppdjv0qwjd"
+     "gy9ynjgdhqgm873jny530f5ycg0xrat9cwfphzzglgktr4qge73ltvjgpha06p4"),
+    ('bc', '0.00000001', 1500000000,
+     [('d', "one satoshi"), ('x', 3600)],
+     "lnbc10n1pvkstcqpp5dwrtyullxn7wr8ttsp807k3l2ar6mf825gh36jwqrefdmdu8"
+     "td9sdqjdahx2grnv96x7umgdyxqrrssu7fsj7hmc9l0nxy85r3tpxm9jhheg7aar8v"
+     "fgl78a6j57vf9huah0j6fje9pphyxud9a8r32yadsfwgnfa9l9llv89zs0tlq3el3j"
+     "sgpdwjdpq"),
+    ('bc', '0.00000000001', 1500000000,
+     [('d', "one msat"), ('x', 60)],
+     "lnbc10p1pvkstcqpp563e4uw3xtctwacplt9cchx6aqvqecp7ckmz3lyx68fnxamqn"
+     "4v6sdqddahx2grdwdshgxqzpuhr0vr9ypzefhd3x93zxwwgs23kah2pxyhmwsew0sn"
+     "50nj56pdmchk09jaz3px5et75ad9r57v407sgh55dxt7hrpejfc953hjp38npsqhqn"
+     "rtp"),
+    ('bc', '21', 1600000000,
+     [('d', "ナンセンス 1杯"), ('x', 1)],
+     "lnbc211p04uyqqpp5fcr5pptzhmdckcxwqhqaanlr45ttwg3sje77q8mypdlyw2d5n"
+     "l8qdpquwpc4curk03c9wlrswe78q4eyqc7d8d0xqpphj7uufszej52rp3cgqv83ls3"
+     "ttlknj0m3eueyy8xfv699fny3fgs4n2xvwg2an9jkxgmc5x57nhh4ne9u7hscsdfnn"
+     "dlvrwm5rjpcksp23m64m"),
+    ('tb', '0.0025', 1700000000,
+     [('h', "a description too long to carry " * 8), ('x', 2**30)],
+     "lntb2500u1pj48ugqpp5fv38wa75m50uv8r03p85seqaq26dzgwnl5egevyt25clet"
+     "x6h79qhp55s3agj05sj3det3ncg0xvjm273rpy8dhwwgjt37z4wky80z954nqxq8pq"
+     "qqqqqz0u3nue6zg0wsyglmw64yup7r06zq58vpw2l5xg5hps0mn33s9hyjeuyugru3"
+     "6n89avknlhyrt5ldzm7jket3uprljuxc8a356kyydsq2hvfu2"),
+    ('bcrt', '0.001', 1,
+     [('d', "regtest, earliest date"), ('x', 0)],
+     "lnbcrt1m1qqqqqqppp5auk3yl0r0w2zh2ksv9z72jcvvxdp7g3j0vhthna7c7842e9"
+     "0uwwsdpywfjkwar9wd6zcgr9v9exc6t9wd6zqerpw3jsxqq5yg7axlh5y4gwxnmuap"
+     "x9kar2zzy3xj0m2uaf4yymaw9zwrpsjh94fg8ukxr7nt02tmzv3ketj5atmzwa53ws"
+     "u62h53dqhd3whuxalsq2n23fk"),
+    ('bc', '123.456789', 2**35 - 1,
+     [('d', "latest date"), ('x', 2**60 - 1)],
+     "lnbc123456789u1lllllllpp5ulmvqythd6xm0nfnpd2pwn7hda7sy94kzgu85hlul"
+     "wq7duy3j6psdqjd3shgetnwssxgct5v5xqvllllllllllllyxp9hvsven6a9tgwj6c"
+     "v55kgxr2ssrrm0lehpjhh4483r78m982s5yfc46yvw4ywemd96newfdah4hzf6hcj7"
+     "33t07qwwqu29jt09zgqje9m64"),
+    ('bc', '0.02', 1496314658,
+     [('d', "p2sh fallback"), ('f', "3EktnHQD7RiAE6uzMj2ZifT9YgRrkSgzQX")],
+     "lnbc20m1pvjluezpp50ypxnxly9j9gu3hmhdzszun9zl5xkgk9dgvf7a395mdyjzqm"
+     "y3gsdq4wqe8x6pqveskcmrzv93kkfppj3a24vwu6r8ejrss3axul8rxldph2q7z9pj"
+     "wqkaha3yymcm2vrq5ffpxyd0zuzc7h9axxszfaqakhcn0xz5y4xcwcspwfvjexmzur"
+     "9mapcxxhays69kvcuhhwpqh4gzmy9s4zljqq0cp4xj"),
+    ('bc', '0.02', 1496314658,
+     [('d', "segwit fallback"),
+      ('f', "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4")],
+     "lnbc20m1pvjluezpp5933yyvkd6gshwy55m7anzzk2qq9qma4v3dntd9kepmcxlhhm"
+     "vj3sdqcwdjkwamfwssxvctvd33xzcmtfppqw508d6qejxtdg4y5r3zarvary0c5xw7"
+     "k7vd6cdgt38rwte9ld6ees34t3wan3qd5xwttpyxzpy5tj633uswngwnaameqyrgma"
+     "3zpy5a9fdnvsays0j2rw9aalhl0358cgvfhslqp8zzj0y"),
+    ('bc', '0.00001', 1496314658,
+     [('n', SPEC_NODE), ('d', "with node id")],
+     "lnbc10u1pvjluezpp5r9vpuf770nksplcuu59jq3l854nuw6cuht46he00q0muxqtm"
+     "kkmsnp4q0n326hr8v9zprg8gsvezcch06gfaqqhde2aj730yg0durunfhv66dq5wa5"
+     "hg6pqdehkgefqd9jqupfqqeg89en7rnznjjlqc23nde0mka3fdw3k4cqy0gxlyajl8"
+     "wf3ag7tef34g7nxqd3ylfwt75zwc2dm8ulsdt4gcl9kfxjsz5kv2ggpyfwrmn"),
+    ('bc', '0.0001', 1496314658,
+     [('d', "with route"), ('r', ROUTE), ('x', 86400)],
+     "lnbc100u1pvjluezpp5ffzdc9fkggz2srlgp6grj32uc9sg9qvzpl3tync72ge6me4"
+     "0rh2sdqswa5hg6pqwfhh2ar9r9yq20q82gphp2nflc7jtzrcazrra7wwgzxqc8u775"
+     "4cdlpfrmccae92qgzqvzq2ps8pqqqqqqpqqqqq9qqqvpeuqafqxu92d8lr6fvg0r5g"
+     "v0heeeqgcrqlnm6jhphu9y00rrhy4grqszsvpcgpy9qqqqqqgqqqqq7qqzqxqyz5vq"
+     "rsuuxwjtm90u7upsa5wxsfjwpw4ytvmskdhmlgnnq2jgzjzrc6y88d6ve30uvag6qh"
+     "jpjqu78g2qfx9k0evelr9704fg03aecd33knqq57j98w"),
+    ('bc', '9.99999999999', 1234567890,
+     [("d", "x" * 100)],
+     "lnbc9999999999990p1pyevqkjpp5flyzkf4wedra9p5vfma7xkqhx2370j7vdsh0k"
+     "vsx9sypwzs9a6uqd9q0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc"
+     "0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0p"
+     "u8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc0pu8s7rc9arc62fp7pu6ldvztmuv"
+     "4wfxrpy3w4yrc4mdaj5keqgujghzexu84vfxvqkaa6d4zl90309kvctme99tp5rx4h"
+     "ua8xex7jgcm25qsxspwdueqj"),]
+
+
+def payment_hash(n):
+    return hashlib.sha256(str(n).encode()).digest()
+
+
+def lnaddr(currency, amount, date, tags, paymenthash):
+    return LnAddr(paymenthash, Decimal(amount) if amount else None,
+                  currency, tags, date)
+
+###############################################################################
+
+class LnencodeTest(unittest.TestCase):
+    def test_spec_vectors(self):
+        for currency, amount, date, tags, bolt11 in SPEC_VECTORS:
+            addr = lnaddr(currency, amount, date, tags, SPEC_PAYMENT_HASH)
+            self.assertEqual(lnencode(addr, SPEC_PRIVKEY), bolt11)
+
+    def test_matches_bitstring_lnencode(self):
+        for n, (currency, amount, date, tags, bolt11) in enumerate(
+                BITSTRING_VECTORS):
+            addr = lnaddr(currency, amount, date, tags, payment_hash(n))
+            self.assertEqual(lnencode(addr, SPEC_PRIVKEY), bolt11, n)
+
+    def test_rejects_out_of_range_date(self):
+        for date in (-1, 2**35):
+            with self.assertRaises(ValueError):
+                lnencode(lnaddr('bc', None, date, [('d', "d")],
+                                payment_hash(0)), SPEC_PRIVKEY)
+
+###############################################################################
+
+class LndecodeTest(unittest.TestCase):
+    def assertDecodes(self, addr, currency, amount, date, tags, paymenthash):
+        self.assertEqual(addr.currency, currency)
+        self.assertEqual(addr.amount, Decimal(amount) if amount else None)
+        self.assertEqual(addr.date, date)
+        self.assertEqual(addr.paymenthash, paymenthash)
+        # 'h' comes back hashed, and 'n' as the pubkey rather than a tag
+        self.assertEqual(addr.tags, [
+            (k, hashlib.sha256(v.encode('utf-8')).digest() if k == 'h' else v)
+            for k, v in tags if k != 'n'])
+
+    def vectors(self):
+        for currency, amount, date, tags, bolt11 in (SPEC_VECTORS +
+                                                     [SPEC_TESTNET]):
+            yield bolt11, (currency, amount, date, tags, SPEC_PAYMENT_HASH)
+        for n, (currency, amount, date, tags, bolt11) in enumerate(
+                BITSTRING_VECTORS):
+            yield bolt11, (currency, amount, date, tags, payment_hash(n))
+
+    def test_fields_without_verify(self):
+        for bolt11, fields in self.vectors():
+            addr = lndecode(bolt11, verify=False)
+            self.assertDecodes(addr, *fields)
+            self.assertIsNone(addr.pubkey)
+
+    def test_round_trip(self):
+        rng = random.Random(13)
+        for n in range(50):
+            tags = [('d', "".join(chr(rng.randrange(32, 0x3000))
+                                  for _ in range(rng.randrange(1, 80)))),
+                    ('x', rng.randrange(2**rng.randrange(1, 60)))]
+            fields = (rng.choice(['bc', 'tb', 'bcrt']),
+                      rng.choice([None, '0.00000000001', '0.001', '2.5',
+                                  str(Decimal(rng.randrange(1, 10**15)) /
+                                      10**11)]),
+                      rng.randrange(2**35), tags, payment_hash(n))
+            bolt11 = lnencode(lnaddr(*fields), SPEC_PRIVKEY)
+            self.assertDecodes(lndecode(bolt11, verify=False), *fields)
+
+    def test_bad_signature_is_only_noticed_with_verify(self):
+        # the vector with an 'n' field, whose key the signature must match
+        bolt11 = [v[4] for v in BITSTRING_VECTORS if ('n', SPEC_NODE) in v[3]]
+        hrp, data = bech32.bech32_decode(bolt11[0])
+        data[-60] ^= 1
+        bad = bech32.bech32_encode(hrp, data)
+        lndecode(bad, verify=False)
+        if hasattr(secp256k1, 'ALL_FLAGS'):
+            with self.assertRaises(ValueError):
+                lndecode(bad)
+
+    @unittest.skipUnless(hasattr(secp256k1, 'ALL_FLAGS'),
+                         "lndecode needs secp256k1 0.13 (see requirements.txt)"
+                         " to verify")
+    def test_verify_gives_the_same_fields(self):
+        for bolt11, fields in self.vectors():
+            addr = lndecode(bolt11)
+            self.assertDecodes(addr, *fields)
+            self.assertEqual(addr.pubkey.serialize(), SPEC_NODE)
+
+###############################################################################
+
+# From BIP173: strings with a valid checksum, and ones to reject
+BECH32_VALID = [
+    "A12UEL5L",
+    "a12uel5l",
+    "an83characterlonghumanreadablepartthatcontainsthenumber1andtheexcluded"
+    "charactersbio1tt5tgs",
+    "abcdef1qpzry9x8gf2tvdw0s3jn54khce6mua7lmqqqxw",
+    "split1checkupstagehandshakeupstreamerranterredcaperred2y9e3w",
+    "?1ezyfcl",
+]
+BECH32_INVALID = [
+    " 1nwldj5", "\x7f1axkwrx", "pzry9x0s0muk", "1pzry9x0s0muk", "x1b4n0q5v",
+    "li1dgmt3", "de1lg7wt\xff", "A1G7SGD8", "10a06t8", "1qzzfhee",
+    "a12UEL5L",
+]
+
+
+class Bech32Test(unittest.TestCase):
+    def implementations(self):
+        # the pure Python functions, and _bech32's when it is built
+        yield bech32.PURE_PYTHON
+        if bech32.HAVE_SPEEDUPS:
+            yield {name: getattr(bech32, name) for name in bech32.PURE_PYTHON}
+
+    def test_polymod_matches_reference(self):
+        rng = random.Random(12)
+        cases = [([], 1), ([0], 1), ([31], 1), ([31] * 7, 2**30 - 1)]
+        for length in range(1, 120):
+            cases.append(([rng.randrange(32) for _ in range(length)],
+                          rng.randrange(2**30)))
+        for functions in self.implementations():
+            polymod = functions['bech32_polymod']
+            for values, chk in cases:
+                self.assertEqual(
+                    polymod(values, chk),
+                    bech32._bech32_polymod_reference(values, chk))
+
+    def test_create_checksum_matches_reference(self):
+        rng = random.Random(12)
+        for hrp in ("lnbc", "lntb", "lnbcrt", "bc", "a"):
+            data = [rng.randrange(32) for _ in range(rng.randrange(300))]
+            checksum = bech32.bech32_create_checksum(hrp, data)
+            self.assertEqual(bech32._bech32_polymod_reference(
+                bech32.bech32_hrp_expand(hrp) + data + checksum), 1)
+
+    def test_bip173_vectors(self):
+        for functions in self.implementations():
+            for bech in BECH32_VALID:
+                hrp, data = functions['bech32_decode'](bech)
+                self.assertIsNotNone(hrp, bech)
+                self.assertEqual(functions['bech32_encode'](hrp, data),
+                                 bech.lower())
+            for bech in BECH32_INVALID:
+                self.assertEqual(functions['bech32_decode'](bech),
+                                 (None, None), repr(bech))
+
+    def test_convertbits_round_trip(self):
+        rng = random.Random(12)
+        for functions in self.implementations():
+            convertbits = functions['convertbits']
+            for length in range(0, 70):
+                data = [rng.randrange(256) for _ in range(length)]
+                u5 = convertbits(data, 8, 5)
+                self.assertEqual(u5, bech32.PURE_PYTHON['convertbits'](
+                    data, 8, 5))
+                self.assertEqual(convertbits(u5, 5, 8, False), data)
+
+    @unittest.skipUnless(bech32.HAVE_SPEEDUPS, "_bech32 isn't built")
+    def test_extension_matches_pure_python(self):
+        # what 'python3 -m lightning_payencode.build_ext --check' runs
+        from lightning_payencode import build_ext
+        self.assertEqual(build_ext.check(count=20), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,642 @@
+#! /usr/bin/env python3
+"""
+Regression tests for mock_c_lightning, run with either of:
+
+    python3 -m pytest -q test_mock_c_lightning.py
+    python3 -m unittest test_mock_c_lightning
+
+Each test gets its own temp directory for the state files.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import shutil
+import tempfile
+import unittest
+import subprocess
+from random import Random
+from unittest import mock
+
+import mock_c_lightning
+from mock_c_lightning import MockDaemon, Invoice
+from rpc_server import RpcDispatcher, RpcServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def labels(daemon, **kwargs):
+    return [i['label'] for i in daemon.listinvoices(**kwargs)['invoices']]
+
+
+class ScratchTestCase(unittest.TestCase):
+    """ Points all of mock_c_lightning's files into a fresh temp directory,
+    where a child process started with self.env finds them too. """
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix="mock-c-lightning-test")
+        self.saved_dir = os.path.dirname(mock_c_lightning.STATE_FILE)
+        mock_c_lightning.set_state_dir(self.scratch)
+        self.env = dict(os.environ, TMPDIR=self.scratch)
+
+    def tearDown(self):
+        mock_c_lightning.set_state_dir(self.saved_dir)
+        shutil.rmtree(self.scratch)
+
+    def run_python(self, code):
+        # runs code in a child process that shares the scratch state files
+        return subprocess.run([sys.executable, '-c', code], cwd=HERE,
+                              env=self.env, capture_output=True, text=True,
+                              timeout=60)
+
+###############################################################################
+
+class JournalTest(ScratchTestCase):
+    def test_append_after_torn_record_survives(self):
+        daemon = MockDaemon(False, mock_bolt11=True, backend='journal')
+        daemon.invoice(1000, 'before', "d", 3600, None)
+        daemon.close()
+        with open(mock_c_lightning.JOURNAL_FILE, 'a') as f:
+            f.write('{"op": "add", "invoi')
+
+        daemon = MockDaemon(False, mock_bolt11=True, backend='journal')
+        daemon.invoice(1000, 'after', "d", 3600, None)
+        daemon.close()
+
+        daemon = MockDaemon(False, mock_bolt11=True, backend='journal')
+        labels = [i['label'] for i in daemon.listinvoices()['invoices']]
+        daemon.close()
+        self.assertEqual(labels, ['before', 'after'])
+
+###############################################################################
+
+class ListInvoicesTest(ScratchTestCase):
+    def test_negative_limit_and_offset_rejected_on_every_backend(self):
+        for backend, in_memory in [('json', True), ('json', False),
+                                   ('journal', False), ('sqlite', False)]:
+            daemon = MockDaemon(in_memory, mock_bolt11=True, backend=backend)
+            daemon.invoice(1000, 'a', "d", 3600, None)
+            self.assertEqual(daemon.listinvoices(limit=-1),
+                             {"code": -1, "message": "Invalid limit"})
+            self.assertEqual(daemon.listinvoices(offset=-1),
+                             {"code": -1, "message": "Invalid offset"})
+            self.assertEqual(len(daemon.listinvoices(limit=0)['invoices']),
+                             0)
+            daemon.reset()
+            daemon.close()
+
+    def test_after_pay_index_with_and_without_label(self):
+        for backend, in_memory in [('json', True), ('sqlite', False)]:
+            daemon = MockDaemon(in_memory, mock_bolt11=True, backend=backend)
+            daemon.invoice(1000, 'u', "d", 3600, None)
+            daemon.invoice(1000, 'p', "d", 3600, None)
+            daemon.markpaid('p')
+            for label in ('u', 'p'):
+                self.assertEqual(labels(daemon, label=label,
+                                        after_pay_index=0),
+                                 [n for n in labels(daemon, after_pay_index=0)
+                                  if n == label])
+            self.assertEqual(labels(daemon, label='p', after_pay_index=1),
+                             [])
+            self.assertEqual(daemon.listinvoices(label='u',
+                                                 after_pay_index=-1),
+                             {"code": -1,
+                              "message": "Invalid after_pay_index"})
+            daemon.reset()
+            daemon.close()
+
+    def test_cli_rejects_negative_limit(self):
+        for option in ('--limit', '--after-pay-index'):
+            result = subprocess.run([sys.executable, 'mock_c_lightning.py',
+                                     'listinvoices', option, '-1'], cwd=HERE,
+                                    env=self.env, capture_output=True,
+                                    text=True, timeout=60)
+            self.assertEqual(result.returncode, 2)
+            self.assertIn("is negative", result.stderr)
+
+###############################################################################
+
+class StoreTest(ScratchTestCase):
+    """ DaemonState's indexes and heaps, checked through MockDaemon on each
+    backend. """
+    BACKENDS = ('memory', 'json', 'journal', 'sqlite')
+
+    def open(self, backend, fresh=False):
+        in_memory = backend == 'memory'
+        daemon = MockDaemon(in_memory, mock_bolt11=True,
+                            backend='json' if in_memory else backend)
+        if fresh:
+            # json and journal share the state file
+            daemon.reset()
+        return daemon
+
+    def reopen(self, daemon):
+        # the state as the next CLI invocation sees it
+        if daemon.state.in_memory:
+            return daemon
+        daemon.close()
+        return self.open(daemon.backend)
+
+    def test_indexes_follow_pay_delete_and_readd(self):
+        for backend in self.BACKENDS:
+            with self.subTest(backend=backend):
+                daemon = self.open(backend, fresh=True)
+                daemon.invoice(1000, 'a', "d", 3600, None)
+                daemon.invoice(1000, 'b', "d", 3600, None)
+                daemon.markpaid('a')
+                self.assertEqual(labels(daemon, label='a', status='paid'),
+                                 ['a'])
+                self.assertEqual(labels(daemon, after_pay_index=0), ['a'])
+                daemon.delinvoice('a', 'paid')
+                self.assertEqual(labels(daemon, label='a'), [])
+                self.assertEqual(labels(daemon, after_pay_index=0), [])
+
+                daemon.invoice(2000, 'a', "d", 3600, None)
+                daemon = self.reopen(daemon)
+                self.assertEqual(labels(daemon), ['b', 'a'])
+                i, = daemon.listinvoices(label='a')['invoices']
+                self.assertEqual((i['status'], i['msatoshi']),
+                                 ('unpaid', 2000))
+                with self.assertRaises(SystemExit):
+                    daemon.invoice(1000, 'a', "d", 3600, None)
+                daemon.close()
+
+    def pay_indexes(self, daemon):
+        return {i['label']: i['pay_index']
+                for i in daemon.listinvoices(status='paid')['invoices']}
+
+    def test_pay_index_not_reused(self):
+        for backend in self.BACKENDS:
+            with self.subTest(backend=backend):
+                daemon = self.open(backend, fresh=True)
+                for label in 'abc':
+                    daemon.invoice(1000, label, "d", 3600, None)
+                daemon.markpaid('a')
+                daemon.delinvoice('a', 'paid')
+                daemon = self.reopen(daemon)
+                daemon.markpaid('b')
+                daemon.markpaid('c')
+                daemon.markpaid('b')
+                daemon = self.reopen(daemon)
+                self.assertEqual(self.pay_indexes(daemon), {'b': 4, 'c': 3})
+                self.assertEqual(labels(daemon, after_pay_index=0),
+                                 ['c', 'b'])
+                daemon.close()
+
+    def test_state_file_without_counter_is_migrated(self):
+        # as written before next_pay_index and the autoclean counters
+        invoices = [Invoice(label, mock_c_lightning.MOCK_BOLT11,
+                            bytes(32), 1000, 1500003600)
+                    for label in 'abc']
+        invoices[0].update({'status': Invoice.PAID, 'paid_at': 1500000000,
+                            'msatoshi_received': 1033, 'pay_index': 5})
+        state = {'time_offset':             0,
+                 'autoclean_cycle_seconds': 0,
+                 'autoclean_last_clean':    None,
+                 'autoclean_expired_by':    86400,
+                 'invoices':                [i.to_json() for i in invoices]}
+        for backend in ('json', 'journal'):
+            with self.subTest(backend=backend):
+                with open(mock_c_lightning.STATE_FILE, 'w') as f:
+                    json.dump(state, f)
+                daemon = self.open(backend)
+                self.assertEqual(daemon.state['next_pay_index'], 6)
+                self.assertEqual(daemon.state['autoclean_total_cleaned'], 0)
+                daemon.markpaid('b')
+                daemon = self.reopen(daemon)
+                daemon.markpaid('c')
+                self.assertEqual(self.pay_indexes(daemon),
+                                 {'a': 5, 'b': 6, 'c': 7})
+                daemon.close()
+                os.remove(mock_c_lightning.STATE_FILE)
+                if os.path.exists(mock_c_lightning.JOURNAL_FILE):
+                    os.remove(mock_c_lightning.JOURNAL_FILE)
+
+    @mock.patch('time.time', return_value=1500000000.0)
+    def test_expiry(self, _):
+        for backend in self.BACKENDS:
+            with self.subTest(backend=backend):
+                daemon = self.open(backend, fresh=True)
+                for n in range(100):
+                    daemon.invoice(1000, str(n), "d", 10, None)
+                daemon.invoice(1000, 'paid', "d", 10, None)
+                daemon.invoice(1000, 'readded', "d", 10, None)
+                daemon.markpaid('paid')
+                daemon.delinvoice('readded', 'unpaid')
+                daemon.invoice(1000, 'readded', "d", 3600, None)
+
+                daemon.advancetime(10)
+                self.assertEqual(labels(daemon, status='expired'), [])
+                daemon = self.reopen(daemon)
+                daemon.advancetime(1)
+                self.assertEqual(labels(daemon, status='expired'),
+                                 [str(n) for n in range(100)])
+                self.assertEqual(labels(daemon, status='paid'), ['paid'])
+                self.assertEqual(labels(daemon, status='unpaid'),
+                                 ['readded'])
+                daemon.close()
+
+    @mock.patch('time.time', return_value=1500000000.0)
+    def test_autoclean(self, _):
+        for backend in self.BACKENDS:
+            with self.subTest(backend=backend):
+                daemon = self.open(backend, fresh=True)
+                daemon.invoice(1000, 'old', "d", 10, None)
+                daemon.invoice(1000, 'new', "d", 200, None)
+                daemon.invoice(1000, 'paid', "d", 10, None)
+                daemon.invoice(1000, 'unpaid', "d", 3600, None)
+                daemon.markpaid('paid')
+                daemon.autocleaninvoice(60, 100)
+
+                daemon.advancetime(150)
+                self.assertEqual(labels(daemon), ['new', 'paid', 'unpaid'])
+                self.assertEqual(daemon.getstats()['autoclean'],
+                                 {'cycle_cleaned': 1, 'total_cleaned': 1})
+                # every later cycle, only 'new' (once it has been expired
+                # for 100 seconds) goes, and nothing is listed twice
+                seen = []
+                for _ in range(8):
+                    daemon = self.reopen(daemon)
+                    daemon.advancetime(60)
+                    seen.append(labels(daemon))
+                self.assertEqual(seen, [['new', 'paid', 'unpaid']] * 2 +
+                                       [['paid', 'unpaid']] * 6)
+                self.assertEqual(daemon.getstats(reset=True)['autoclean'],
+                                 {'cycle_cleaned': 0, 'total_cleaned': 2})
+                self.assertEqual(daemon.getstats()['autoclean'],
+                                 {'cycle_cleaned': 0, 'total_cleaned': 2})
+                daemon.close()
+
+    def random_ops(self, random, count):
+        ops = []
+        for _ in range(count):
+            label = "l%d" % random.randrange(12)
+            op = random.choice(['invoice', 'invoice', 'markpaid',
+                                'delinvoice', 'advancetime',
+                                'autocleaninvoice', 'listinvoices'])
+            if op == 'invoice':
+                ops.append((op, random.randrange(1, 10000), label, "d",
+                            random.choice([10, 600, 3600]),
+                            "%064x" % random.getrandbits(256)))
+            elif op == 'markpaid':
+                ops.append((op, label))
+            elif op == 'delinvoice':
+                ops.append((op, label, random.choice(Invoice.STATUSES)))
+            elif op == 'advancetime':
+                ops.append((op, random.choice([1, 60, 900])))
+            elif op == 'autocleaninvoice':
+                ops.append((op, random.choice([0, 1, 300]),
+                            random.choice([0, 100, 1000])))
+            else:
+                ops.append((op, random.choice([None, label]),
+                            random.choice((None,) + Invoice.STATUSES),
+                            random.choice([None, 0, 3]),
+                            random.choice([0, 2]),
+                            random.choice([None, 0, 4])))
+        return ops
+
+    def test_randomized_backends_agree(self):
+        ops = self.random_ops(Random(1), 400)
+        results = []
+        # one clock for every backend, so that they expire the same invoices
+        with mock.patch('time.time', return_value=1500000000.0):
+            for backend in self.BACKENDS:
+                daemon = self.open(backend, fresh=True)
+                steps = []
+                for op, *args in ops:
+                    try:
+                        result = getattr(daemon, op)(*args)
+                    except SystemExit as e:
+                        result = str(e)
+                    steps.append((op, result, daemon.listinvoices()))
+                    daemon = self.reopen(daemon)
+                daemon.close()
+                results.append(steps)
+        for backend, steps in zip(self.BACKENDS[1:], results[1:]):
+            with self.subTest(backend=backend):
+                self.assertEqual(steps, results[0])
+
+###############################################################################
+
+class InvoiceTest(unittest.TestCase):
+    def test_json_round_trip(self):
+        unpaid = Invoice('a', mock_c_lightning.MOCK_BOLT11, bytes(range(32)),
+                         1000, 1500003600)
+        self.assertEqual(unpaid.to_json(),
+                         {'label': 'a',
+                          'bolt11': mock_c_lightning.MOCK_BOLT11,
+                          'payment_hash': bytes(range(32)).hex(),
+                          'msatoshi': 1000,
+                          'status': 'unpaid',
+                          'expires_at': 1500003600,
+                          'expiry_time': 1500003600})
+        fields = {'status': Invoice.PAID, 'paid_at': 1500000000,
+                  'msatoshi_received': 1033, 'pay_index': 1}
+        json_fields = Invoice.fields_to_json(fields)
+        self.assertEqual(Invoice.fields_from_json(json_fields), fields)
+
+        paid = Invoice.from_json(unpaid.to_json())
+        paid.update(fields)
+        i = paid.to_json()
+        self.assertEqual(Invoice.from_json(i).to_json(), i)
+        self.assertEqual(dict(unpaid.to_json(), **json_fields), i)
+        self.assertFalse(hasattr(paid, '__dict__'))
+
+###############################################################################
+
+class InvoiceBatchTest(ScratchTestCase):
+    def invoicebatch(self, *lines):
+        path = os.path.join(self.scratch, "specs.jsonl")
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        return subprocess.run([sys.executable, 'mock_c_lightning.py',
+                               'invoicebatch', path], cwd=HERE, env=self.env,
+                              capture_output=True, text=True, timeout=60)
+
+    def test_bad_json_line_named(self):
+        result = self.invoicebatch(
+            '{"msatoshi": 1000, "label": "a", "description": "d"}', '',
+            '{"msatoshi": 1000, "label": "b", "description": }')
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("line 3 isn't JSON", result.stderr)
+        self.assertNotIn("Traceback", result.stderr)
+
+    def test_bad_specs_rejected(self):
+        daemon = MockDaemon(True, mock_bolt11=True)
+        for spec in [[1000, "a", "d"],
+                     {'msatoshi': 1000, 'label': 1, 'description': "d"},
+                     {'msatoshi': 1000, 'label': "a", 'description': None},
+                     {'msatoshi': "lots", 'label': "a", 'description': "d"},
+                     {'msatoshi': 1000, 'label': "a", 'description': "d",
+                      'preimage': "zz"}]:
+            with self.assertRaises(SystemExit) as cm:
+                daemon.invoice_batch([spec])
+            self.assertTrue(str(cm.exception).startswith("*** "), spec)
+        self.assertEqual(daemon.listinvoices(), {'invoices': []})
+
+###############################################################################
+
+class StatsTest(ScratchTestCase):
+    def test_untimed_commands_leave_no_stats(self):
+        daemon = MockDaemon(True, mock_bolt11=True, stats=True)
+        daemon.run_cmd(['waitanyinvoice', '--timeout', '0.01'])
+        daemon.run_cmd(['advancetime', '1'])
+        stats = daemon.getstats()
+        self.assertEqual(sorted(stats['commands']), ['advancetime'])
+
+###############################################################################
+
+class RpcParamsTest(ScratchTestCase):
+    def call(self, dispatcher, method, params):
+        return asyncio.run(dispatcher.handle({'id': 1, 'method': method,
+                                              'params': params}))
+
+    def test_wrong_types_rejected_before_running(self):
+        daemon = MockDaemon(True, mock_bolt11=True)
+        dispatcher = RpcDispatcher(daemon)
+        for method, params in [('autocleaninvoice', ["x"]),
+                               ('advancetime', [0.5]),
+                               ('advancetime', [True]),
+                               ('invoice', ["1000", "a", "d"]),
+                               ('invoice', [1000, 1, "d"]),
+                               ('invoice', [1000, "a", "d", 60, "zz"]),
+                               ('listinvoices', {'limit': -1}),
+                               ('listinvoices', {'after_pay_index': -1}),
+                               ('waitanyinvoice', [0, "1"]),
+                               ('getstats', [1]),
+                               ('invoicebatch', [[], 0]),
+                               ('invoicebatch', [[], os.cpu_count() + 1])]:
+            response = self.call(dispatcher, method, params)
+            self.assertEqual(response['error']['code'], -32602,
+                             (method, params))
+        self.assertEqual(daemon.state['time_offset'], 0)
+        self.assertEqual(daemon.listinvoices(), {'invoices': []})
+
+        response = self.call(dispatcher, 'invoice', [1000, "a", "d"])
+        self.assertIn('bolt11', response['result'])
+        self.assertIsNone(self.call(dispatcher, 'markpaid', ["a"])['result'])
+
+    def test_failed_markpaid_keeps_pay_index(self):
+        daemon = MockDaemon(True, mock_bolt11=True)
+        daemon.state.add_invoice(mock_c_lightning.Invoice(
+            'a', "lnbc", b"\x11" * 32, "1000", daemon._get_time() + 60))
+        with self.assertRaises(TypeError):
+            daemon.markpaid('a')
+        self.assertEqual(daemon.state['next_pay_index'], 1)
+
+###############################################################################
+
+class ServeTest(ScratchTestCase):
+    def rpc(self, rpc_file, method, params):
+        with socket.socket(socket.AF_UNIX) as s:
+            s.connect(rpc_file)
+            s.sendall(json.dumps({'id': 1, 'method': method,
+                                  'params': params}).encode('utf8'))
+            response = b''
+            while not response.endswith(b"\n\n"):
+                response += s.recv(65536)
+        return json.loads(response)
+
+    def test_sigterm_flushes_and_removes_socket(self):
+        rpc_file = os.path.join(self.scratch, "rpc")
+        server = subprocess.Popen(
+            [sys.executable, 'mock_c_lightning.py', 'serve', '--rpc-file',
+             rpc_file, '--write-behind', '30'], cwd=HERE, env=self.env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            deadline = time.monotonic() + 30
+            while not os.path.exists(rpc_file):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            for n in range(3):
+                self.rpc(rpc_file, 'invoice', [1000, "a%d" % n, "d"])
+        finally:
+            server.terminate()
+            _, stderr = server.communicate(timeout=30)
+        self.assertEqual(server.returncode, 0, stderr)
+        self.assertFalse(os.path.exists(rpc_file))
+        with open(mock_c_lightning.STATE_FILE) as f:
+            labels = [i['label'] for i in json.load(f)['invoices']]
+        self.assertEqual(labels, ['a0', 'a1', 'a2'])
+
+###############################################################################
+
+class RpcWaitTest(ScratchTestCase):
+    def test_timed_out_waiters_are_dropped(self):
+        daemon = MockDaemon(True, mock_bolt11=True)
+        dispatcher = RpcDispatcher(daemon)
+
+        async def wait_many():
+            for n in range(20):
+                response = await dispatcher.handle(
+                    {'id': n, 'method': 'waitanyinvoice',
+                     'params': [0, 0.001]})
+                self.assertEqual(response['error']['code'], 904)
+        asyncio.run(wait_many())
+        self.assertEqual(dispatcher.pay_waiters, [])
+        self.assertEqual(dispatcher.label_waiters, {})
+
+    def test_waiter_wakes_on_markpaid(self):
+        daemon = MockDaemon(True, mock_bolt11=True)
+        daemon.invoice(1000, 'a', "d", 3600, None)
+        dispatcher = RpcDispatcher(daemon)
+
+        async def wait_and_pay():
+            waiter = asyncio.ensure_future(dispatcher.handle(
+                {'id': 1, 'method': 'waitinvoice', 'params': ['a']}))
+            await asyncio.sleep(0.01)
+            await dispatcher.handle({'id': 2, 'method': 'markpaid',
+                                     'params': ['a']})
+            return await asyncio.wait_for(waiter, 5)
+        response = asyncio.run(wait_and_pay())
+        self.assertEqual(response['result']['status'], 'paid')
+        self.assertEqual(dispatcher.label_waiters, {})
+
+    def test_hanging_up_cancels_a_pending_wait(self):
+        daemon = MockDaemon(True, mock_bolt11=True)
+        rpc_file = os.path.join(self.scratch, "lightning-rpc")
+        server = RpcServer(rpc_file, daemon)
+
+        async def hang_up_waiting():
+            await asyncio.start_unix_server(server._handle_connection,
+                                            path=rpc_file)
+            reader, writer = await asyncio.open_unix_connection(rpc_file)
+            # pipelined requests are still answered in order
+            writer.write(b'{"id": 1, "method": "invoice", '
+                         b'"params": [1000, "a", "d"]}'
+                         b'{"id": 2, "method": "listinvoices"}')
+            first = json.loads(await reader.readuntil(b"\n\n"))
+            second = json.loads(await reader.readuntil(b"\n\n"))
+            self.assertEqual((first['id'], second['id']), (1, 2))
+
+            writer.write(b'{"id": 3, "method": "waitanyinvoice"}')
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(server.dispatcher.pay_waiters), 1)
+            writer.close()
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if not server.dispatcher.pay_waiters:
+                    break
+            # (asyncio.run() would cancel the request anyway on the way out)
+            self.assertEqual(server.dispatcher.pay_waiters, [])
+        asyncio.run(hang_up_waiting())
+        server.close()
+
+###############################################################################
+
+class Bolt11Test(unittest.TestCase):
+    def test_template_matches_encode_bolt11(self):
+        template = mock_c_lightning.Bolt11Template()
+        payment_hash = "11" * 32
+        for msatoshi in [0, 1, 1000, 2500000000, 123456789012345678,
+                         9999999999999999]:
+            self.assertEqual(
+                mock_c_lightning.encode_bolt11(msatoshi, "d", 60,
+                                               payment_hash, 1500000000),
+                template.encode(msatoshi, "d", 60, payment_hash, 1500000000))
+
+    def test_big_amount_is_exact(self):
+        bolt11 = mock_c_lightning.encode_bolt11(123456789012345678, "d", 60,
+                                                "11" * 32, 1500000000)
+        self.assertTrue(bolt11.startswith("lnbc1234567890123456780p1"))
+
+###############################################################################
+
+class LazyBolt11Test(unittest.TestCase):
+    def setUp(self):
+        self.daemon = MockDaemon(True, stats=False, lazy_bolt11=True)
+
+    def invoice(self, label):
+        # the response, and the bolt11 eager signing gives for it
+        response = self.daemon.invoice(1000, label, "d", 3600, None)
+        i = self.daemon.state.get_invoice(label)
+        self.assertFalse(i.bolt11_signed)
+        bolt11 = mock_c_lightning.encode_bolt11(
+            1000, "d", 3600, i.payment_hash.hex(), i.expires_at - 3600)
+        return response, bolt11
+
+    def test_unread_response_leaves_bolt11_unsigned(self):
+        self.daemon.invoice(1000, 'a', "d", 3600, None)
+        self.daemon.invoice_batch([{'msatoshi': 1000, 'label': 'b',
+                                    'description': "d"}])
+        self.assertFalse(self.daemon.state.get_invoice('a').bolt11_signed)
+        self.assertFalse(self.daemon.state.get_invoice('b').bolt11_signed)
+
+    def test_every_accessor_sees_the_bolt11(self):
+        accessors = [
+            lambda r: r['bolt11'], lambda r: r.get('bolt11'),
+            lambda r: r.pop('bolt11'), lambda r: r.setdefault('bolt11'),
+            lambda r: dict(r)['bolt11'], lambda r: {**r}['bolt11'],
+            lambda r: r.copy()['bolt11'], lambda r: dict(r.items())['bolt11'],
+            lambda r: list(r.values())[-1],
+            lambda r: json.loads(json.dumps(r, default=dict))['bolt11']]
+        for n, accessor in enumerate(accessors):
+            response, bolt11 = self.invoice('a%d' % n)
+            self.assertEqual(accessor(response), bolt11)
+
+    def test_writes_before_reading(self):
+        response, bolt11 = self.invoice('a')
+        response['extra'] = 1
+        del response['expiry_time']
+        response.update(more=2)
+        self.assertEqual(response['bolt11'], bolt11)
+        self.assertEqual(sorted(response), ['bolt11', 'expires_at', 'extra',
+                                            'more', 'payment_hash'])
+
+    def test_compares_equal_to_dict(self):
+        response, bolt11 = self.invoice('a')
+        expected = dict(response)
+        self.assertEqual(expected['bolt11'], bolt11)
+        self.assertEqual(response, expected)
+        self.assertEqual(len(response), len(expected))
+
+    def test_raw_dict_access_fails_loudly(self):
+        response, _ = self.invoice('a')
+        with self.assertRaises(TypeError):
+            dict.get(response, 'bolt11')
+
+    def test_batch_response(self):
+        outputs = self.daemon.invoice_batch(
+            [{'msatoshi': 1000, 'label': 'b', 'description': "d"}])
+        i = self.daemon.state.get_invoice('b')
+        self.assertEqual(dict(outputs['invoices'][0]),
+                         {'label': 'b', 'payment_hash': i.payment_hash.hex(),
+                          'expires_at': i.expires_at,
+                          'expiry_time': i.expires_at,
+                          'bolt11': mock_c_lightning.encode_bolt11(
+                              1000, "d", 3600, i.payment_hash.hex(),
+                              i.expires_at - 3600)})
+
+###############################################################################
+
+class SqliteTest(ScratchTestCase):
+    def test_idle_daemon_leaves_database_writable(self):
+        # a long-lived daemon (eg. 'serve') alongside CLI writers
+        daemon = MockDaemon(False, mock_bolt11=True, backend='sqlite')
+        daemon.invoice(1000, 'a', "d", 3600, None)
+        daemon.listinvoices()
+        result = self.run_python(
+            "import sqlite3\n"
+            "db = sqlite3.connect(%r, timeout=1)\n"
+            "db.execute('UPDATE invoices SET msatoshi = msatoshi')\n"
+            "db.commit()\n" % mock_c_lightning.SQLITE_FILE)
+        daemon.close()
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_cli_writes_while_daemon_is_open(self):
+        daemon = MockDaemon(False, mock_bolt11=True, backend='sqlite')
+        daemon.invoice(1000, 'a', "d", 3600, None)
+        daemon.listinvoices()
+        self.env['MOCK_C_LIGHTNING_BACKEND'] = 'sqlite'
+        self.env['MOCK_C_LIGHTNING_STATS'] = ''
+        result = subprocess.run([sys.executable, 'mock_c_lightning.py',
+                                 'markpaid', 'a'], cwd=HERE, env=self.env,
+                                capture_output=True, text=True, timeout=60)
+        daemon.close()
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()